@@ -10,20 +10,36 @@ Codmonの仕様を網羅しているわけではありません。
 """
 
 import argparse
-from datetime import date, time, datetime, timedelta
+import asyncio
+import collections
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import csv
+from datetime import date, time, datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+import functools
 import getpass
+import hashlib
+import heapq
+import html
+import itertools
 # import gettext
 import json
 import logging
+import mimetypes
+import multiprocessing
 import os
 import os.path as p
 import pathlib
 import pickle
+import queue
+import random
 import re
 import requests
+import shutil
+import sqlite3
 import sys
-import textwrap
-from time import sleep
+import threading
+from time import sleep, monotonic
 import urllib
 import unicodedata
 
@@ -33,11 +49,101 @@ _THISDIR = p.dirname(__file__)
 
 _DATA = p.expanduser("~/Desktop/dumpmon")
 _DUMPDIR = p.join(_DATA, "dump")
+_BLOBDIR = p.join(_DATA, "blobs")
 _DEFAULT_OUTPUTDIR = p.join(_DATA, "output")
 
 _TOP_URL = 'https://ps-api.codmon.com'
 _API_URL = _TOP_URL + "/api/v2/parent"
 
+# アクセス間隔の既定値 (1秒に1リクエスト、同時接続数4)
+_DEFAULT_RATE = 1.0
+_DEFAULT_BURST = 1
+_DEFAULT_WORKERS = 4
+# HTTPクライアント httpxは非同期クライアントでAPIを取得する(httpxが必要)
+_HTTP_CLIENTS = ("requests", "httpx")
+_DEFAULT_HTTP_CLIENT = "requests"
+# httpxのホストごとの同時接続数 ここに無いホストは--workersまで
+_HOST_LIMITS = {
+    "ps-api.codmon.com": 4,
+    "api-reference-room.codmon.com": 2,
+}
+_HTTP_TIMEOUT = 60.0
+# 失敗したリクエストの再試行 待ち時間は指数的に増やしてばらつかせる(Retry-Afterがあればそれ以上待つ)
+_RETRIES = 10
+_RETRY_STATUS = (429, 500, 502, 503, 504)
+_BACKOFF_BASE = 0.5
+_BACKOFF_MAX = 60.0
+# 添付ファイルの同時ダウンロード数と、ストリーミングで書き込む単位
+_DEFAULT_DOWNLOADS = 4
+# ページ送りのAPIで、処理中のページの次に先読みしておくページ数
+# 既定の1リクエスト/秒ではレート制限の間隔が1回の往復より長く、先読みしても速くならず
+# 使わないページを取得するだけなので0にする (rate×往復時間が1を超えるなら--prefetchで増やす)
+_PREFETCH_PAGES = 0
+# --pipelineで取得からダウンロードへ渡すjobのキューの大きさ 超えると取得が待つ
+_PIPELINE_QUEUE = 64
+_CHUNK_SIZE = 64 * 1024
+# ダウンロード途中のファイルの拡張子
+_PART_EXT = ".part"
+
+# comments, contact_responsesを一度に問い合わせる期間(日数)
+_WINDOW_DAYS = {
+    "day": 1,
+    "week": 7,
+    "month": 31,
+}
+# 件数が_PAGE_CAPに達した期間はgetWindowJsonが分割して取り直すので、既定は月ごとにする
+# (dayは期間の分割がうまくいかないサーバー向けに残す)
+_DEFAULT_WINDOW = "month"
+# 一度に取得する最大件数 これに達したら期間を分割して取り直す
+_PAGE_CAP = 1000
+
+# ダンプしたitemの保存形式 json: itemごとのjsonファイル sqlite: 1つのSQLiteファイル
+_STORES = ("json", "sqlite")
+_DEFAULT_STORE = "json"
+_STORE_FILE = "dump.sqlite3"
+# 全文検索のインデックス (_DUMPDIRに置く)
+_SEARCH_FILE = "search.sqlite3"
+_SEARCH_LIMIT = 50
+
+# 実行中に読み込んだitemをキャッシュする上限(メモリ上の大きさの見積もりの合計)
+_DEFAULT_CACHE_BYTES = 64 * 1024 * 1024
+# キャッシュしたitemのメモリ上の大きさの見積もり jsonのファイルサイズの倍数
+# (tracemallocで測ると約2.7倍 辞書や文字列オブジェクト、キャッシュのキーの分)
+_CACHE_ITEM_FACTOR = 3
+# デコードしたcontentのメモリ上の大きさの見積もり contentの文字数の倍数 (測ると約4.4倍)
+_CACHE_CONTENT_FACTOR = 5
+# DumpedItemで共有する(internする)文字列の値の最大長 種類や日付が入る長さ
+# (日時はitemごとにほぼ異なり、internしてもinternの表が大きくなるだけなので含めない)
+_INTERN_LEN = 16
+
+# 連絡帳の生成方法を変えたら上げる (月ごとの連絡帳をすべて作り直す)
+_NOTE_VERSION = 2
+
+# 睡眠表(sleep.csv)の1スロットの分数
+_SLEEP_PARMIN = 5
+
+# 分析用に書き出す表の列と型 型は int64, float64, string, date, time, timestamp
+_CONDITION_KEYS = (
+    "mood_morning", "mood_afternoon", "meal_morning", "meal_evening", "evacuation_morning", "evacuation_evening")
+_ANALYTICS_TABLES = {
+    "temperatures": (
+        ("service_id", "string"), ("source", "string"), ("date", "date"), ("datetime", "timestamp"),
+        ("temperature", "float64")),
+    "sleeps": (
+        ("service_id", "string"), ("date", "date"), ("start", "time"), ("end", "time"), ("minutes", "int64")),
+    "attendances": (
+        ("date", "date"), ("start", "time"), ("end", "time"), ("minutes", "int64")),
+    "conditions": (
+        ("service_id", "string"), ("source", "string"), ("date", "date"), ("datetime", "timestamp"))
+    + tuple((key, "string") for key in _CONDITION_KEYS),
+}
+_ANALYTICS_FORMATS = ("csv", "parquet")
+
+# 連絡帳の本文を折り返す幅 全角は幅2 (全角30文字)
+_WRAP_WIDTH = 60
+# 行頭に来ないように前の文字につなげる約物
+_WRAP_CLOSING = "、。，．・：；？！ー）」』】〕〉》"
+
 _DEFAULT_CONFIG = {
     # Codmon Login Id
     "id": None,
@@ -80,6 +186,721 @@ class Config(object):
             os.remove(self.fn)
 
 
+class Cursors(object):
+    """ エンドポイントごとの取得済み位置(カーソル)を保存します。
+
+    カーソルは最新itemのid, update_datetime, 日付を持ちます。
+    advance()した位置はcommit()するまで保存されません。
+    エンドポイントの取得が最後まで終わってからcommit()することで、
+    途中で失敗しても次回に取りこぼしが起きないようにします。
+    """
+
+    def __init__(self):
+        self.appdatadir = get_appdatadir() / "dumpmon"
+        self.fn = p.join(self.appdatadir, "cursors.json")
+        self.cursors = {}
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        if p.isfile(self.fn):
+            with open(self.fn, 'r') as f:
+                self.cursors = json.load(f)
+        else:
+            self.cursors = {}
+
+    def save(self):
+        with open(self.fn, 'w') as f:
+            json.dump(self.cursors, f, indent=2)
+
+    def get(self, key):
+        return self.cursors.get(key)
+
+    def advance(self, key, item_id, stamp, item_date):
+        u""" keyのカーソルをitemの位置まで進める(より新しい場合のみ) """
+        def order(cur):
+            return (cur["update_datetime"] or "", cur["date"] or "")
+        new = {"id": item_id, "update_datetime": stamp, "date": item_date}
+        with self.lock:
+            cur = self.pending.get(key) or self.cursors.get(key)
+            if cur is None or order(new) > order(cur):
+                self.pending[key] = new
+
+    def commit(self):
+        u""" advance()した位置を保存する """
+        with self.lock:
+            if not self.pending:
+                return
+            self.cursors.update(self.pending)
+            self.pending = {}
+            self.save()
+
+    def clean(self):
+        if p.isfile(self.fn):
+            os.remove(self.fn)
+
+
+class ItemStore(object):
+    """ ダンプしたitemを1つのSQLiteファイルに保存します。
+
+    itemは(service, kind, id)で一意で、同じitemは上書き(upsert)されます。
+    nameはjsonファイルで保存する場合のファイル名で、書き出し(export)に使います。
+    display_dateはnameの先頭の日付で、日付範囲の検索に使います。
+    """
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(fn, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS items ("
+                " service TEXT NOT NULL,"
+                " kind TEXT NOT NULL,"
+                " id TEXT NOT NULL,"
+                " name TEXT NOT NULL,"
+                " display_date TEXT,"
+                " update_datetime TEXT,"
+                " data TEXT NOT NULL,"
+                " PRIMARY KEY (service, kind, id))")
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS items_date ON items (service, kind, display_date)")
+
+    def _put(self, service, kind, item_id, name, display_date, update_datetime, item):
+        data = json.dumps(item, ensure_ascii=False)
+        self.conn.execute(
+            "INSERT INTO items (service, kind, id, name, display_date, update_datetime, data)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)"
+            " ON CONFLICT (service, kind, id) DO UPDATE SET"
+            " name=excluded.name, display_date=excluded.display_date,"
+            " update_datetime=excluded.update_datetime, data=excluded.data",
+            (service, kind, str(item_id), name, display_date, update_datetime, data))
+
+    def put(self, service, kind, item_id, name, display_date, update_datetime, item):
+        with self.lock, self.conn:
+            self._put(service, kind, item_id, name, display_date, update_datetime, item)
+
+    def putMany(self, rows):
+        u""" put()の引数のタプルのイテレータをまとめて1回のトランザクションで入れる
+
+        Returns:
+            int: 入れた数
+        """
+        n = 0
+        with self.lock, self.conn:
+            for row in rows:
+                self._put(*row)
+                n += 1
+        return n
+
+    def count(self):
+        with self.lock:
+            return self.conn.execute("SELECT count(*) FROM items").fetchone()[0]
+
+    def iterItems(self, service, kind, s_date=None, e_date=None):
+        u""" display_date順に(name, item)を返すイテレータ
+
+        s_date, e_dateを指定するとその範囲(両端を含む)に限定する
+        読み出し用の接続を別に開くので、書き込みと並行して使えます。
+        """
+        sql = "SELECT name, data FROM items WHERE service=? AND kind=?"
+        params = [service, kind]
+        if s_date is not None:
+            sql += " AND display_date >= ?"
+            params.append(s_date.isoformat())
+        if e_date is not None:
+            sql += " AND display_date <= ?"
+            params.append(e_date.isoformat())
+        sql += " ORDER BY display_date, name"
+        conn = sqlite3.connect(self.fn)
+        try:
+            for name, data in conn.execute(sql, params):
+                yield name, json.loads(data)
+        finally:
+            conn.close()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class SearchIndex(object):
+    """ 保存したitemの本文をSQLiteのFTS5で全文検索します。
+
+    docsに(service, kind, id)ごとの日付、タイトル、本文を持ち、docs_ftsに同じrowidで検索用の語を入れます。
+    日本語は単語に区切れないので、英数字以外の並びは2文字ずつ(bigram)と最後の1文字を語にします。
+    本文が変わっていないitemは入れ直しません。
+    """
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(fn, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS docs ("
+                " rowid INTEGER PRIMARY KEY,"
+                " service TEXT NOT NULL,"
+                " kind TEXT NOT NULL,"
+                " id TEXT NOT NULL,"
+                " display_date TEXT,"
+                " title TEXT,"
+                " text TEXT NOT NULL,"
+                " UNIQUE (service, kind, id))")
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS docs_date ON docs (display_date)")
+            self.conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS docs_fts USING fts5("
+                " tokens, tokenize='unicode61 remove_diacritics 0')")
+
+    def _put(self, service, kind, item_id, display_date, title, text):
+        row = self.conn.execute(
+            "SELECT rowid, display_date, title, text FROM docs WHERE service=? AND kind=? AND id=?",
+            (service, kind, str(item_id))).fetchone()
+        if row is not None:
+            if row[1:] == (display_date, title, text):
+                return
+            self.conn.execute("DELETE FROM docs_fts WHERE rowid=?", (row[0],))
+            self.conn.execute(
+                "UPDATE docs SET display_date=?, title=?, text=? WHERE rowid=?",
+                (display_date, title, text, row[0]))
+            rowid = row[0]
+        else:
+            rowid = self.conn.execute(
+                "INSERT INTO docs (service, kind, id, display_date, title, text) VALUES (?, ?, ?, ?, ?, ?)",
+                (service, kind, str(item_id), display_date, title, text)).lastrowid
+        self.conn.execute(
+            "INSERT INTO docs_fts (rowid, tokens) VALUES (?, ?)",
+            (rowid, " ".join(searchTokens(title + "\n" + text))))
+
+    def put(self, service, kind, item_id, display_date, title, text):
+        with self.lock, self.conn:
+            self._put(service, kind, item_id, display_date, title, text)
+
+    def putMany(self, docs):
+        u""" (service, kind, id, display_date, title, text)のイテレータをまとめて1回のトランザクションで入れる
+
+        Returns:
+            int: 入れた数
+        """
+        n = 0
+        with self.lock, self.conn:
+            for doc in docs:
+                self._put(*doc)
+                n += 1
+        return n
+
+    def count(self):
+        with self.lock:
+            return self.conn.execute("SELECT count(*) FROM docs").fetchone()[0]
+
+    def search(self, query, services=None, s_date=None, e_date=None, limit=_SEARCH_LIMIT):
+        u""" queryを含むitemを新しい順に返す
+
+        queryの空白で区切った語をすべて含むitemに一致します。
+
+        Args:
+            query (str): 検索語
+            services (list, optional): service_idのリスト 指定するとそのサービスに限定する
+            s_date (date, optional): この日以降に限定する
+            e_date (date, optional): この日以前に限定する
+            limit (int, optional): 最大件数
+
+        Returns:
+            list: (service, kind, id, display_date, title, text)のリスト
+        """
+        match = searchQuery(query)
+        if not match:
+            return []
+        sql = (
+            "SELECT d.service, d.kind, d.id, d.display_date, d.title, d.text"
+            " FROM docs_fts f JOIN docs d ON d.rowid = f.rowid"
+            " WHERE docs_fts MATCH ?")
+        params = [match]
+        if services:
+            sql += " AND d.service IN (%s)" % ", ".join("?" * len(services))
+            params.extend(services)
+        if s_date is not None:
+            sql += " AND d.display_date >= ?"
+            params.append(s_date.isoformat())
+        if e_date is not None:
+            sql += " AND d.display_date <= ?"
+            params.append(e_date.isoformat())
+        sql += " ORDER BY d.display_date DESC, d.rowid DESC LIMIT ?"
+        params.append(limit)
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class DumpedItem(object):
+    """ 保存したitem
+
+    読むだけならdictと同じように item["id"], item.get("id"), "id" in item が使えます。
+    日付は作るときに1回だけ解析して date, displayDate, dateTime に持ちます(無ければNone)。
+    "content"のjson文字列は初めて content() を呼んだときにデコードして持ちます。
+    jsonから読んだdictはitemごとにキーの文字列を別に持つので、キーと短い文字列の値(種類や日付)を
+    internして全itemで共有します。1件あたりのメモリは読み込んだままのdictより小さくなります。
+    """
+    __slots__ = ("data", "date", "displayDate", "dateTime", "_content")
+
+    def __init__(self, data):
+        self.data = {sys.intern(k): internShort(v) for k, v in data.items()}
+        self.date = parseItemDate(data)
+        displayDate = parseDisplayDate(data)
+        # 同じ日付なら同じdateオブジェクトを使う
+        self.displayDate = self.date if displayDate == self.date else displayDate
+        self.dateTime = parseItemDateTime(data)
+        self._content = None
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def __repr__(self):
+        return "DumpedItem(%r)" % (self.data,)
+
+    @property
+    def decoded(self):
+        return self._content is not None
+
+    def content(self):
+        u""" "content"のjsonをデコードして返す 2回目からはデコードした結果を返す """
+        if self._content is None:
+            self._content = json.loads(self.data["content"])
+        return self._content
+
+
+class ItemCache(object):
+    """ 読み込んだitemのjsonファイルを実行中キャッシュします。
+
+    (path, mtime, size)をキーにするので、ファイルが書き換えられたら読み直します。
+    itemの"content"(json文字列)のデコード結果はDumpedItemが持ち、その分もキャッシュの大きさに数えます。
+    メモリ上の大きさはファイルサイズの_CACHE_ITEM_FACTOR倍、デコードしたcontentは文字数の
+    _CACHE_CONTENT_FACTOR倍と見積もり、その合計がmaxbytesを超えたら、使われていないものから捨てます(LRU)。
+    """
+
+    def __init__(self, maxbytes=_DEFAULT_CACHE_BYTES):
+        self.maxbytes = maxbytes
+        # key: [item, size]
+        self.entries = collections.OrderedDict()
+        # id(item): key
+        self.keys = {}
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def load(self, fn, loader, store=True):
+        u""" fnをloaderで読み込んだitemを返す キャッシュにあればそれを返す
+
+        storeがFalseなら、読み込んだitemはキャッシュに入れない(全件を1回だけ読む処理用)
+        """
+        st = os.stat(fn)
+        key = (fn, st.st_mtime_ns, st.st_size)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        item = loader(fn)
+        if not store:
+            return item
+        with self.lock:
+            if key not in self.entries:
+                size = st.st_size * _CACHE_ITEM_FACTOR
+                self.entries[key] = [item, size]
+                self.keys[id(item)] = key
+                self.nbytes += size
+                self.evict()
+        return item
+
+    def content(self, item):
+        u""" item["content"]をデコードして返す DumpedItemならデコード結果はitemが持つ """
+        if not isinstance(item, DumpedItem):
+            return json.loads(item["content"])
+        if item.decoded:
+            return item.content()
+        content = item.content()
+        with self.lock:
+            key = self.keys.get(id(item))
+            entry = self.entries.get(key) if key else None
+            if entry is not None:
+                size = len(item["content"]) * _CACHE_CONTENT_FACTOR
+                entry[1] += size
+                self.nbytes += size
+                self.evict()
+        return content
+
+    def evict(self):
+        while self.nbytes > self.maxbytes and self.entries:
+            key, (item, size) = self.entries.popitem(last=False)
+            self.keys.pop(id(item), None)
+            self.nbytes -= size
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.keys.clear()
+            self.nbytes = 0
+
+
+class BlobStore(object):
+    """ ダウンロードしたファイルの内容をsha256で1つだけ保存します。
+
+    outputフォルダのファイルはここへのハードリンク(できなければコピー)にします。
+    同じPDFや画像が別の題名や日付で何度あっても、ディスク上は1つになります。
+    urlごとにsha256, ETag, Content-Length, 名前付けに使うヘッダを記録しておき、
+    既知のurlやETagならダウンロードせずにリンクします。
+    """
+
+    # 名前付けに使うため記録するレスポンスヘッダ
+    HEADERS = ("Content-Disposition", "Content-Type")
+
+    def __init__(self, root=_BLOBDIR):
+        self.root = root
+        self.fn = p.join(root, "index.json")
+        self.lock = threading.Lock()
+        self.urls = {}
+        self.etags = {}
+        self.dirty = False
+        os.makedirs(root, exist_ok=True)
+        self.load()
+
+    def load(self):
+        if p.isfile(self.fn):
+            with open(self.fn, 'r', encoding="utf-8") as f:
+                self.urls = json.load(f)
+        self.etags = {}
+        for entry in self.urls.values():
+            if entry.get("etag"):
+                self.etags[entry["etag"]] = entry
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            tmp = self.fn + ".tmp"
+            with open(tmp, 'w', encoding="utf-8") as f:
+                json.dump(self.urls, f, ensure_ascii=False, indent=1)
+            os.replace(tmp, self.fn)
+            self.dirty = False
+
+    def path(self, sha):
+        return p.join(self.root, sha[:2], sha)
+
+    def exists(self, entry):
+        return entry is not None and p.isfile(self.path(entry["sha256"]))
+
+    def lookupUrl(self, url):
+        u""" urlの記録を返す 内容が保存済みでなければNone """
+        with self.lock:
+            entry = self.urls.get(url)
+        return entry if self.exists(entry) else None
+
+    def lookupEtag(self, etag, length):
+        u""" ETagとContent-Lengthが一致する記録を返す 無ければNone """
+        if not etag:
+            return None
+        with self.lock:
+            entry = self.etags.get(etag)
+        if entry is None or (length is not None and entry.get("length") != length):
+            return None
+        return entry if self.exists(entry) else None
+
+    def add(self, url, fn, sha, headers):
+        u""" ダウンロードしたファイルfnを内容として保存し、urlの記録を追加する fnは移動する """
+        blob = self.path(sha)
+        os.makedirs(p.dirname(blob), exist_ok=True)
+        if p.isfile(blob):
+            os.remove(fn)
+        else:
+            os.replace(fn, blob)
+        return self.record(url, sha, headers)
+
+    def record(self, url, sha, headers):
+        entry = {
+            "sha256": sha,
+            "etag": headers.get("ETag"),
+            "length": p.getsize(self.path(sha)),
+            "headers": {k: headers[k] for k in self.HEADERS if k in headers},
+        }
+        with self.lock:
+            self.urls[url] = entry
+            if entry["etag"]:
+                self.etags[entry["etag"]] = entry
+            self.dirty = True
+        return entry
+
+    def link(self, entry, dst):
+        u""" 保存した内容をdstにハードリンクする できなければコピーする """
+        blob = self.path(entry["sha256"])
+        tmp = dst + ".link"
+        try:
+            os.link(blob, tmp)
+        except OSError:
+            shutil.copyfile(blob, tmp)
+        os.replace(tmp, dst)
+
+
+class Manifest(object):
+    """ ダウンロード済みのitemと、書き出したファイルの記録です。
+
+    key(itemの種類とid)ごとに、ファイル名(root相対)、サイズ、sha256を記録します。
+    記録のファイルがすべて同じサイズで存在すれば、そのitemはダウンロード済みです。
+    フォルダの走査やサーバーへのアクセス無しでダウンロード済みか判定できます。
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.fn = p.join(root, "_manifest.json")
+        self.lock = threading.Lock()
+        self.items = {}
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        if p.isfile(self.fn):
+            with open(self.fn, 'r', encoding="utf-8") as f:
+                self.items = json.load(f)
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            tmp = self.fn + ".tmp"
+            with open(tmp, 'w', encoding="utf-8") as f:
+                json.dump(self.items, f, ensure_ascii=False, indent=1)
+            os.replace(tmp, self.fn)
+            self.dirty = False
+
+    def complete(self, key):
+        u""" keyのファイルがすべて揃っていればTrue """
+        with self.lock:
+            entry = self.items.get(key)
+        if entry is None:
+            return False
+        for f in entry["files"]:
+            try:
+                if os.stat(p.join(self.root, f["name"])).st_size != f["size"]:
+                    return False
+            except FileNotFoundError:
+                return False
+        return True
+
+    def record(self, key, files):
+        u""" keyのファイルを記録する
+
+        Args:
+            key (str): itemの種類とid
+            files (list): (ファイルのパス, sha256またはNone)のリスト
+        """
+        entry = {"files": [{
+            "name": p.relpath(fn, self.root),
+            "size": p.getsize(fn),
+            "sha256": sha,
+        } for fn, sha in files]}
+        with self.lock:
+            self.items[key] = entry
+            self.dirty = True
+
+
+class HttpCache(object):
+    """ ETag/Last-Modifiedを持つレスポンスを保存し、条件付きリクエストに使います。
+
+    urlごとに<sha1>.json(検証用ヘッダとレスポンスヘッダ)と<sha1>.body(本体)を保存します。
+    サーバーが304を返したら保存した本体からレスポンスを作ります。
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, url):
+        return p.join(self.root, hashlib.sha1(url.encode("utf-8")).hexdigest())
+
+    def lookup(self, url):
+        u""" urlの保存した検証用ヘッダ等を返す 無ければNone """
+        fn = self.path(url)
+        if not (p.isfile(fn + ".json") and p.isfile(fn + ".body")):
+            return None
+        with open(fn + ".json", 'r', encoding="utf-8") as f:
+            return json.load(f)
+
+    def conditionalHeaders(self, meta):
+        headers = {}
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+        return headers
+
+    def store(self, url, res):
+        u""" resに検証用ヘッダがあれば保存する """
+        etag = res.headers.get("ETag")
+        last_modified = res.headers.get("Last-Modified")
+        if not (etag or last_modified):
+            return
+        meta = {
+            "url": url,
+            "etag": etag,
+            "last_modified": last_modified,
+            "encoding": res.encoding,
+            "headers": dict(res.headers),
+        }
+        fn = self.path(url)
+        with open(fn + ".body.tmp", 'wb') as f:
+            f.write(res.content)
+        os.replace(fn + ".body.tmp", fn + ".body")
+        with open(fn + ".json.tmp", 'w', encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(fn + ".json.tmp", fn + ".json")
+
+    def response(self, url, meta):
+        u""" 保存した本体から200のレスポンスを作る """
+        res = requests.models.Response()
+        with open(self.path(url) + ".body", 'rb') as f:
+            res._content = f.read()
+        res.status_code = 200
+        res.url = url
+        res.encoding = meta["encoding"]
+        res.headers = requests.structures.CaseInsensitiveDict(meta["headers"])
+        return res
+
+    def count(self, hit):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+
+class TokenBucket(object):
+    """ トークンバケット方式のレート制限
+
+    rate(リクエスト/秒)でトークンが補充され、最大burst個まで溜まります。
+    acquire()はトークンを1つ消費し、トークンが無ければ補充されるまで待ちます。
+    スレッド間で共有できます。
+    """
+
+    def __init__(self, rate=_DEFAULT_RATE, burst=_DEFAULT_BURST):
+        if rate <= 0:
+            raise ValueError("rate must be positive: %r" % rate)
+        self.rate = float(rate)
+        self.burst = max(1, int(burst))
+        self.tokens = float(self.burst)
+        self.stamp = monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+                self.stamp = now
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return
+                wait = (1.0 - self.tokens) / self.rate
+            sleep(wait)
+
+
+class AsyncHttpClient(object):
+    """ httpxの非同期クライアントでGETします。
+
+    イベントループを専用のスレッドで回し、どのスレッドからもget()で同期的に呼べます。
+    接続はkeep-aliveで使い回し、h2があればHTTP/2にします。
+    ホストごとに同時接続数を_HOST_LIMITSまでに制限します。
+    接続エラーと_RETRY_STATUSはbackoffDelay()だけ待って再試行します。
+    アクセス間隔はlimiterで守ります。
+    """
+
+    def __init__(self, limiter, workers=_DEFAULT_WORKERS, hostLimits=_HOST_LIMITS):
+        import httpx
+        try:
+            import h2  # noqa: F401
+            http2 = True
+        except ImportError:
+            http2 = False
+        self.httpx = httpx
+        self.limiter = limiter
+        self.workers = max(1, int(workers))
+        self.hostLimits = hostLimits
+        # host: asyncio.Semaphore ループのスレッドだけが触る
+        self.semaphores = {}
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="dumpmon-http", daemon=True)
+        self.thread.start()
+        self.client = self.call(self.open(http2))
+
+    def call(self, coro):
+        u""" coroをループのスレッドで実行して結果を返す """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    async def open(self, http2):
+        n = max([self.workers] + list(self.hostLimits.values()))
+        limits = self.httpx.Limits(max_connections=n * 2, max_keepalive_connections=n * 2)
+        return self.httpx.AsyncClient(http2=http2, limits=limits, timeout=_HTTP_TIMEOUT)
+
+    def semaphore(self, host):
+        sem = self.semaphores.get(host)
+        if sem is None:
+            sem = asyncio.Semaphore(self.hostLimits.get(host, self.workers))
+            self.semaphores[host] = sem
+        return sem
+
+    async def fetch(self, url, headers):
+        async with self.semaphore(urllib.parse.urlsplit(url).hostname):
+            for i in range(_RETRIES):
+                await self.loop.run_in_executor(None, self.limiter.acquire)
+                try:
+                    res = await self.client.get(url, headers=headers)
+                except self.httpx.TransportError as e:
+                    if i + 1 == _RETRIES:
+                        raise RuntimeError("retry over: %s" % url) from e
+                    delay = backoffDelay(i)
+                    log.error("retry: %d %s %r (%.1f sec)" % (i, url, e, delay))
+                else:
+                    if res.status_code not in _RETRY_STATUS or i + 1 == _RETRIES:
+                        return res
+                    delay = backoffDelay(i, parseRetryAfter(res.headers.get("Retry-After")))
+                    log.warning("retry: %d %s %d (%.1f sec)" % (i, url, res.status_code, delay))
+                await asyncio.sleep(delay)
+
+    def get(self, url, headers):
+        u""" urlをGETしてrequestsのResponseにして返す bodyは読み込み済み """
+        r = self.call(self.fetch(url, headers))
+        res = requests.models.Response()
+        res._content = r.content
+        res.status_code = r.status_code
+        res.reason = r.reason_phrase
+        res.url = str(r.url)
+        res.encoding = r.charset_encoding
+        res.headers = requests.structures.CaseInsensitiveDict(r.headers)
+        return res
+
+    def close(self):
+        self.call(self.client.aclose())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
 class Dumpmon(object):
     """ DumpmonはCodmonサイトへのアクセスとデータの吐き出しを行います。
 
@@ -87,25 +908,64 @@ class Dumpmon(object):
         object (_type_): _description_
     """
 
-    def __init__(self, start_date=None, end_date=None, outputdir=None):
+    def __init__(self, start_date=None, end_date=None, outputdir=None,
+                 rate=_DEFAULT_RATE, burst=_DEFAULT_BURST, workers=_DEFAULT_WORKERS,
+                 window=_DEFAULT_WINDOW, incremental=False, store=_DEFAULT_STORE,
+                 cache_bytes=_DEFAULT_CACHE_BYTES, downloads=_DEFAULT_DOWNLOADS, httpcache=True,
+                 http=_DEFAULT_HTTP_CLIENT, prefetch=_PREFETCH_PAGES):
         self.s_date = start_date
         self.e_date = end_date
+        self.window = window
+        # incrementalなら前回までに取得済みのitemに達したところで取得をやめる
+        self.incremental = incremental
         self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=max(workers, 10))
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        # すべてのフェーズで共有するレート制限とワーカー
+        self.limiter = TokenBucket(rate, burst)
+        self.workers = max(1, int(workers))
+        self.pool = ThreadPoolExecutor(max_workers=self.workers)
+        # ページ送りのAPIで先読みするページ数
+        self.prefetch = max(0, int(prefetch))
+        # APIの取得に使う非同期クライアント 添付ファイルのストリーミングはsessionで行う
+        if http not in _HTTP_CLIENTS:
+            raise ValueError("unknown http client: %r" % http)
+        self.aclient = AsyncHttpClient(self.limiter, self.workers) if http == "httpx" else None
+        # 添付ファイルのダウンロードは別のワーカーで行う
+        # ダウンロードした内容はblobsに1つだけ保存してoutputからリンクする
+        self.blobs = BlobStore()
+        self.downloads = max(1, int(downloads))
+        self.dlpool = ThreadPoolExecutor(max_workers=self.downloads)
         # create program's directory
         self.appdatadir = get_appdatadir() / "dumpmon"
         self.cookiefile = p.join(self.appdatadir, "cookie.dat")
         self.services_cache = None
         self.children_cache = None
+        # member_id -> service_id, 日付 -> 登園時間情報 初めて使うときに作る
+        self.memberServices = None
+        self.attendances = None
         try:
             self.appdatadir.mkdir(parents=True)
         except FileExistsError:
             pass
+        self.cursors = Cursors()
+        # 変わっていないレスポンスはサーバーに確認して保存したものを使う
+        self.httpcache = HttpCache(str(self.appdatadir / "httpcache")) if httpcache else None
+        # 各フェーズで同じダンプファイルを読み直さないためのキャッシュ
+        self.itemcache = ItemCache(cache_bytes)
 
         if not p.isdir(_DATA):
             os.mkdir(_DATA)
 
         if not p.isdir(_DUMPDIR):
             os.makedirs(_DUMPDIR)
+        if store not in _STORES:
+            raise ValueError("unknown store: %r" % store)
+        self.store = ItemStore(p.join(_DUMPDIR, _STORE_FILE)) if store == "sqlite" else None
+        # 全文検索のインデックス 初めて使うときに開く (dlpoolのスレッドからも呼ばれるのでロックする)
+        self.search = None
+        self.searchLock = threading.Lock()
         # if not p.isdir(_DEFAULT_OUTPUTDIR):
         #     os.makedirs(_DEFAULT_OUTPUTDIR)
 
@@ -115,6 +975,17 @@ class Dumpmon(object):
             self.outputdir = _DEFAULT_OUTPUTDIR
         if not p.isdir(self.outputdir):
             os.makedirs(self.outputdir)
+        # ダウンロード済みitemの記録
+        self.manifest = Manifest(self.outputdir)
+
+    def __getstate__(self):
+        u""" プロセスプールで連絡帳を作るときに送る状態 通信やファイルの状態は送らない """
+        return {"s_date": self.s_date, "e_date": self.e_date, "outputdir": self.outputdir}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.itemcache = ItemCache(0)
+        self.attendances = None
 
     # --- Login
 
@@ -173,25 +1044,63 @@ class Dumpmon(object):
 
     # --- session.get util
 
-    def get(self, url, headers=None):
-        u""" HTTP GET for Codmon session"""
+    def get(self, url, headers=None, stream=False, ok=(200,)):
+        u""" HTTP GET for Codmon session
+
+        Args:
+            url (str): url
+            headers (dict, optional): 追加するヘッダ
+            stream (bool, optional): Trueならbodyを読まずに返す。iter_content()で読むこと。
+            ok (tuple, optional): 成功とするstatus_code
+        """
         log.debug("get: %s" % url)
         defaultHaeders = {
             'User-Agent': 'dumpmon',
         }
         headers = dictmerge(defaultHaeders, (headers or {}))
-        for i in range(10):
-            try:
-                res = self.session.get(url, headers=headers)
-                break
-            except requests.exceptions.ConnectionError:
-                log.error("retry: %d %s" % (i, url))
-                sleep(2.0)
-        if res.status_code != 200:
+        cached = None
+        if self.httpcache is not None and not stream:
+            cached = self.httpcache.lookup(url)
+            if cached is not None:
+                headers = dictmerge(headers, self.httpcache.conditionalHeaders(cached))
+        if self.aclient is not None and not stream:
+            # sessionのcookieなどを付けたヘッダで送る
+            req = self.session.prepare_request(requests.Request("GET", url, headers=headers))
+            res = self.aclient.get(url, dict(req.headers))
+        else:
+            res = self.sessionGet(url, headers, stream)
+        if res.status_code == 304 and cached is not None:
+            log.debug("not modified: %s" % url)
+            self.httpcache.count(True)
+            return self.httpcache.response(url, cached)
+        if res.status_code not in ok:
+            res.close()
             raise RuntimeError("%r" % res)
-        sleep(1.0)
+        if self.httpcache is not None and not stream:
+            self.httpcache.count(False)
+            if res.status_code == 200:
+                self.httpcache.store(url, res)
         return res
 
+    def sessionGet(self, url, headers, stream=False):
+        u""" sessionでGETする 接続エラーと_RETRY_STATUSはbackoffDelay()だけ待って再試行する """
+        for i in range(_RETRIES):
+            self.limiter.acquire()
+            try:
+                res = self.session.get(url, headers=headers, stream=stream)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if i + 1 == _RETRIES:
+                    raise RuntimeError("retry over: %s" % url) from e
+                delay = backoffDelay(i)
+                log.error("retry: %d %s %r (%.1f sec)" % (i, url, e, delay))
+            else:
+                if res.status_code not in _RETRY_STATUS or i + 1 == _RETRIES:
+                    return res
+                res.close()
+                delay = backoffDelay(i, parseRetryAfter(res.headers.get("Retry-After")))
+                log.warning("retry: %d %s %d (%.1f sec)" % (i, url, res.status_code, delay))
+            sleep(delay)
+
     def getJson(self, url):
         res = self.get(url)
         resj = res.json()
@@ -199,6 +1108,257 @@ class Dumpmon(object):
             raise RuntimeError()
         return resj
 
+    def iterMap(self, func, args, pool=None, width=None):
+        u""" argsの各要素でfuncをワーカーで並列に実行し、argsの順番通りに結果を返すイテレータ
+
+        同時に処理中のリクエストはworkers個まで。
+        アクセス間隔はget()内のレート制限で守られます。
+        途中でイテレータを閉じると未着手の処理はキャンセルされます。
+
+        Args:
+            pool (Executor, optional): 実行するワーカー Defaults to self.pool
+            width (int, optional): 同時に処理する数 Defaults to self.workers
+        """
+        pool = pool or self.pool
+        width = width or self.workers
+        pending = collections.deque()
+        try:
+            for arg in args:
+                pending.append(pool.submit(func, arg))
+                if len(pending) >= width:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def iterPages(self, getPage, pages, ahead=None):
+        u""" pagesのページ番号ごとにgetPage(page)を先読みしながら取得し、(page, 結果)をページ順に返すイテレータ
+
+        返したページを処理している間に、次のaheadページ(既定はself.prefetch)をワーカーで取得しておきます。
+        aheadが0なら1ページずつ取得します。
+        アクセス間隔はget()内のレート制限で守られます。
+        最後のページや日付範囲の外に達したら閉じること。まだ始まっていない先読みはキャンセルされます。
+        """
+        if ahead is None:
+            ahead = self.prefetch
+        return self.iterMap(lambda page: (page, getPage(page)), pages, width=ahead + 1)
+
+    def iterGetJson(self, urls):
+        u""" urlsを並列に取得し、順番通りにjsonを返すイテレータ """
+        return self.iterMap(self.getJson, urls)
+
+    # --- download
+
+    def download(self, url, partfn, headers=None, finalName=None):
+        u""" urlをpartfnにストリーミングで保存し、完了したら名前を変更する
+
+        partfnが既にあれば、前回の続きからRangeリクエストで取得します。
+        完了するまでは最終的なファイル名では存在しないので、途中で止まっても完了と誤認しません。
+        内容はblobsに保存して、最終的なファイル名はそこへのリンクにします。
+        urlやETagが既知なら、本体を取得せずにリンクだけします。
+
+        Args:
+            url (str): url
+            partfn (str): ダウンロード途中のファイルのパス (_PART_EXTで終わる)
+            headers (dict, optional): 追加するヘッダ
+            finalName (callable, optional): レスポンスヘッダから保存するファイルのパスを得る関数
+                Defaults to partfnから_PART_EXTを除いたパス
+
+        Returns:
+            str: 保存したファイルのパス
+        """
+        def getName(resHeaders):
+            return finalName(resHeaders) if finalName else partfn[:-len(_PART_EXT)]
+
+        entry = self.blobs.lookupUrl(url)
+        if entry is not None:
+            fn = getName(requests.structures.CaseInsensitiveDict(entry["headers"]))
+            log.info("known url. link: %s" % fn)
+            self.blobs.link(entry, fn)
+            return fn
+
+        reqHeaders = dict(headers or {})
+        offset = p.getsize(partfn) if p.isfile(partfn) else 0
+        if offset:
+            reqHeaders["Range"] = "bytes=%d-" % offset
+        res = self.get(url, headers=reqHeaders, stream=True, ok=(200, 206, 416))
+        try:
+            if res.status_code == 416:
+                # 途中のファイルが壊れているので最初から取得し直す
+                log.warning("bad partial file. retry: %s" % partfn)
+                os.remove(partfn)
+                return self.download(url, partfn, headers=headers, finalName=finalName)
+            if res.status_code == 200:
+                length = res.headers.get("Content-Length")
+                entry = self.blobs.lookupEtag(
+                    res.headers.get("ETag"), int(length) if length else None)
+                if entry is not None:
+                    # 同じ内容を保存済みなので本体は読まない
+                    fn = getName(res.headers)
+                    log.info("known etag. link: %s" % fn)
+                    self.blobs.link(entry, fn)
+                    self.blobs.record(url, entry["sha256"], res.headers)
+                    return fn
+            # 206なら続きから、200ならサーバーがRangeを無視したので最初から書く
+            sha = hashlib.sha256()
+            if res.status_code == 206:
+                mode = 'ab'
+                with open(partfn, 'rb') as f:
+                    for chunk in iter(lambda: f.read(_CHUNK_SIZE), b""):
+                        sha.update(chunk)
+            else:
+                mode = 'wb'
+            with open(partfn, mode) as f:
+                for chunk in res.iter_content(chunk_size=_CHUNK_SIZE):
+                    sha.update(chunk)
+                    f.write(chunk)
+            fn = getName(res.headers)
+            entry = self.blobs.add(url, partfn, sha.hexdigest(), res.headers)
+        finally:
+            res.close()
+        self.blobs.link(entry, fn)
+        return fn
+
+    def recordDownload(self, key, files):
+        u""" ダウンロードしたファイルをmanifestに記録する
+
+        Args:
+            key (str): itemの種類とid
+            files (list): (ファイルのパス, url)のリスト
+        """
+        shas = []
+        for fn, url in files:
+            entry = self.blobs.lookupUrl(url)
+            shas.append((fn, entry["sha256"] if entry else None))
+        self.manifest.record(key, shas)
+
+    def runDownloads(self, jobs):
+        u""" jobs(引数なしの関数)をダウンロード用のワーカーで並列に実行する
+
+        失敗したjobはログに残して残りを続け、最後に最初の例外を送出します。
+        """
+        errors = []
+
+        def run(job):
+            try:
+                job()
+            except Exception as e:
+                log.error("download failed: %r" % e)
+                errors.append(e)
+        try:
+            for _ in self.iterMap(run, jobs, pool=self.dlpool, width=self.downloads):
+                pass
+        finally:
+            self.blobs.save()
+            self.manifest.save()
+        if errors:
+            raise errors[0]
+
+    # --- pipeline
+
+    def iterItemDownloads(self, sid, item):
+        u""" timelineのitemの(key, 添付ファイルと写真をダウンロードするjob)を返すイテレータ sidがNoneならhandout """
+        if sid is None:
+            yield "handout/%s [%s]" % (item["publishFromDateTime"], item["title"]), \
+                lambda: self.downloadHandout(item)
+            return
+        yield "timeline/%s/%s" % (sid, item["id"]), self.timelineDownloadJob(sid, item)
+        yield "album/%s/%s" % (sid, item["id"]), self.timelinePhotoJob(sid, item)
+
+    def runPipeline(self, processes=1, builddoc=True):
+        u""" 取得、ダウンロード、連絡帳の作成、ドキュメントのビルドを重ねて実行する
+
+        取得したtimelineとhandoutのitemは、その場でダウンロードのjobにしてキューで渡し、
+        ダウンロード用のスレッドが取得と並行して処理します。キューがいっぱいなら取得が待ちます。
+        取得が終わったら、前回までに取得してまだダウンロードしていない分をダウンロードに続けて渡し、
+        その間に連絡帳とドキュメントを作ります。
+        連絡帳の1か月はtimeline, comments, contact_responsesからできるので、取得がすべて終わってから作ります。
+        ダウンロードの失敗はjobごとにログに残して続け、最後に最初の例外を送出します。
+
+        Args:
+            processes (int, optional): 連絡帳を作るプロセス数 Defaults to 1.
+            builddoc (bool, optional): Sphinxでドキュメントをビルドする Defaults to True.
+        """
+        jobs = queue.Queue(maxsize=_PIPELINE_QUEUE)
+        queued = set()
+        aborted = threading.Event()
+        drained = threading.Event()
+        errors = []
+
+        def put(sid, item):
+            for key, job in self.iterItemDownloads(sid, item):
+                if job is not None and key not in queued:
+                    queued.add(key)
+                    jobs.put(job)
+
+        def iterLeftovers():
+            srvs = self.getServices()
+            for sid in srvs.keys():
+                for item in self.iterDumpedTimeline(sid, *self.dateRange()):
+                    if self.dateRangeTest(item) == 0:
+                        yield from self.iterItemDownloads(sid, item)
+            for item in self.iterDumpedHandouts():
+                yield from self.iterItemDownloads(None, item)
+
+        def iterJobs():
+            while True:
+                job = jobs.get()
+                if job is None:
+                    drained.set()
+                    break
+                yield job
+            if aborted.is_set():
+                return
+            for key, job in iterLeftovers():
+                if job is not None and key not in queued:
+                    yield job
+
+        def download():
+            try:
+                self.runDownloads(iterJobs())
+            except Exception as e:
+                errors.append(e)
+                # 取得がキューで止まらないように、残りのjobは捨てる
+                if not drained.is_set():
+                    while jobs.get() is not None:
+                        pass
+
+        thread = threading.Thread(target=download, name="pipeline-download", daemon=True)
+        thread.start()
+        start = monotonic()
+        try:
+            try:
+                log.info("fetchTimeline...")
+                self.fetchTimeline(onItem=put)
+                log.info("fetchComments...")
+                self.fetchComments()
+                log.info("fetchContactResponses...")
+                self.fetchContactResponses()
+                log.info("fetchHandouts...")
+                self.fetchHandouts(onItem=lambda item: put(None, item))
+                log.info("fetchAttendances...")
+                self.fetchAttendances()
+            except BaseException:
+                aborted.set()
+                raise
+            finally:
+                jobs.put(None)
+            log.info("fetched: %.1f sec" % (monotonic() - start))
+            log.info("makenote...")
+            self.makenote(processes=processes)
+            if builddoc:
+                log.info("build document...")
+                callSphinxSetup(self.outputdir)
+                callSphinxBuild(self.outputdir)
+            log.info("rendered: %.1f sec" % (monotonic() - start))
+        finally:
+            thread.join()
+        log.info("downloaded: %.1f sec" % (monotonic() - start))
+        if errors:
+            raise errors[0]
+
     # --- json file handle
 
     def dumpjson(self, fn, item):
@@ -209,6 +1369,165 @@ class Dumpmon(object):
         with open(fn, 'r', encoding="utf-8") as f:
             return json.load(f)
 
+    # --- dumped item storage
+
+    def dumpFolder(self, service_id, kind):
+        u""" kindのitemをjsonファイルで保存するフォルダ service_idがNoneならサービス共通 """
+        if service_id is None:
+            return p.join(_DUMPDIR, kind)
+        srvs = self.getServices()
+        return p.join(_DUMPDIR, srvs[service_id]["name"], kind)
+
+    def dumpItem(self, service_id, kind, itemname, item):
+        u""" itemを保存する
+
+        Args:
+            service_id (str): サービスID サービス共通(handouts)ならNone
+            kind (str): timeline, comments, contact_responses, album, handouts
+            itemname (str): jsonファイル名 先頭は日付(YYYY-MM-DD)
+            item (dict): item
+        """
+        self.indexItem(service_id, kind, itemname, item)
+        if self.store is not None:
+            item_id = self.itemId(item, itemname)
+            self.store.put(
+                service_id or "", kind, item_id, itemname,
+                itemname[:10], self.itemStamp(item), item)
+            return
+        fdr = self.dumpFolder(service_id, kind)
+        if not p.isdir(fdr):
+            os.makedirs(fdr)
+        self.dumpjson(p.join(fdr, itemname), item)
+
+    def itemId(self, item, itemname):
+        u""" SQLiteとインデックスでitemを区別するid idもhandoutIdも無ければjsonのファイル名 """
+        item_id = item.get("id", item.get("handoutId"))
+        return itemname if item_id is None else item_id
+
+    def iterDumpedItems(self, service_id, kind, s_date=None, e_date=None, cache=True):
+        u""" 保存したkindのitemを日付順に返すイテレータ
+
+        s_date, e_dateを指定すると、ファイル名(先頭が日付)でその範囲(両端を含む)に絞ってから読み込む
+        cacheがFalseなら、読み込んだitemをキャッシュに入れない(キャッシュにあればそれを使う)
+        """
+        if self.store is not None:
+            for name, item in self.store.iterItems(service_id or "", kind, s_date, e_date):
+                yield DumpedItem(item)
+            return
+        fdr = self.dumpFolder(service_id, kind)
+        if not p.isdir(fdr):
+            return
+        s_name = s_date.isoformat() if s_date else None
+        e_name = e_date.isoformat() if e_date else None
+        for fn in sorted(os.listdir(fdr)):
+            if s_name and fn[:10] < s_name:
+                continue
+            if e_name and fn[:10] > e_name:
+                break
+            yield self.itemcache.load(p.join(fdr, fn), self.loadItem, store=cache)
+
+    def loadItem(self, fn):
+        return DumpedItem(self.loadjson(fn))
+
+    def itemContent(self, item):
+        u""" item["content"]のjsonをデコードして返す 同じitemは一度だけデコードする """
+        return self.itemcache.content(item)
+
+    def dumpTargets(self):
+        u""" 保存するitemの(service_id, kind)のリスト handoutsはservice_idがNone """
+        srvs = self.getServices()
+        kinds = ["timeline", "comments", "contact_responses", "album"]
+        targets = [(sid, kind) for sid in srvs.keys() for kind in kinds]
+        targets.append((None, "handouts"))
+        return targets
+
+    def iterJsonDumps(self, service_id, kind):
+        u""" jsonファイルで保存したkindのitemを、ファイル名順に(ファイル名, item)で返すイテレータ """
+        fdr = self.dumpFolder(service_id, kind)
+        if not p.isdir(fdr):
+            return
+        for fn in sorted(os.listdir(fdr)):
+            if fn.endswith(".json"):
+                yield fn, self.loadjson(p.join(fdr, fn))
+
+    def hasJsonDumps(self):
+        u""" jsonファイルで保存したitemがあればTrue サービスの一覧も無ければ何も保存していない """
+        if not p.isfile(p.join(_DUMPDIR, "services.json")):
+            return False
+        for sid, kind in self.dumpTargets():
+            fdr = self.dumpFolder(sid, kind)
+            if p.isdir(fdr) and any(fn.endswith(".json") for fn in os.listdir(fdr)):
+                return True
+        return False
+
+    def importStore(self):
+        u""" jsonファイルのフォルダ構成で保存したitemをSQLiteに読み込む exportStore()の逆
+
+        Returns:
+            int: 読み込んだitemの数
+        """
+        if self.store is None:
+            return 0
+
+        def iterRows():
+            for sid, kind in self.dumpTargets():
+                for name, item in self.iterJsonDumps(sid, kind):
+                    yield (sid or "", kind, self.itemId(item, name), name,
+                           name[:10], self.itemStamp(item), item)
+        return self.store.putMany(iterRows())
+
+    def exportStore(self):
+        u""" SQLiteに保存したitemを、jsonファイルのフォルダ構成で書き出す """
+        if self.store is None:
+            return
+        for sid, kind in self.dumpTargets():
+            fdr = self.dumpFolder(sid, kind)
+            for name, item in self.store.iterItems(sid or "", kind):
+                if not p.isdir(fdr):
+                    os.makedirs(fdr)
+                self.dumpjson(p.join(fdr, name), item)
+
+    # --- full text search
+
+    def searchIndex(self):
+        u""" 全文検索のインデックスを返す 初めて呼ばれたときに1つだけ開く """
+        if self.search is None:
+            with self.searchLock:
+                if self.search is None:
+                    self.search = SearchIndex(p.join(_DUMPDIR, _SEARCH_FILE))
+        return self.search
+
+    def searchDoc(self, service_id, kind, itemname, item):
+        u""" 検索インデックスに入れる(service, kind, id, display_date, title, text) 本文が無ければNone """
+        title, text = itemSearchText(kind, item)
+        if not (title or text):
+            return None
+        return (service_id or "", kind, self.itemId(item, itemname), itemname[:10], title, text)
+
+    def indexItem(self, service_id, kind, itemname, item):
+        u""" 取得したitemを検索インデックスに入れる """
+        doc = self.searchDoc(service_id, kind, itemname, item)
+        if doc is not None:
+            self.searchIndex().put(*doc)
+
+    def reindex(self):
+        u""" 保存済みのitemをすべて検索インデックスに入れる 変わっていないitemはそのまま
+
+        Returns:
+            int: 調べたitemの数
+        """
+        def iterDocs():
+            for sid, kind in self.dumpTargets():
+                if self.store is not None:
+                    items = self.store.iterItems(sid or "", kind)
+                else:
+                    items = self.iterJsonDumps(sid, kind)
+                for name, item in items:
+                    doc = self.searchDoc(sid, kind, name, item)
+                    if doc is not None:
+                        yield doc
+        return self.searchIndex().putMany(iterDocs())
+
     # --- fetch services list
 
     def getServices(self):
@@ -251,16 +1570,7 @@ class Dumpmon(object):
             return 0
         if self.e_date is None:
             return 0
-        if "display_date" in item:
-            item_date = date.fromisoformat(item["display_date"])
-        elif "insert_datetime" in item:  # "2022-04-01 15:42:09",
-            item_date = date.fromisoformat(item["insert_datetime"].split(" ")[0])
-        elif "start_date" in item:
-            item_date = date.fromisoformat(item["start_date"])
-        elif "publishFromDateTime" in item:  # "2022-04-01T10:40:44Z",
-            item_date = date.fromisoformat(item["publishFromDateTime"].split("T")[0])
-        else:
-            raise RuntimeError('Unknown date key: %r' % item)
+        item_date = self.itemDate(item)
         a, b = sorted([self.s_date, self.e_date])
         if item_date < a:
             return -1
@@ -269,12 +1579,62 @@ class Dumpmon(object):
         else:
             return 0
 
+    def dateRange(self):
+        u""" self.s_date, self.e_dateを(古い日, 新しい日)の順で返す 範囲指定なしなら(None, None) """
+        if self.s_date is None or self.e_date is None:
+            return None, None
+        return tuple(sorted([self.s_date, self.e_date]))
+
+    def itemDate(self, item):
+        item_date = item.date if isinstance(item, DumpedItem) else parseItemDate(item)
+        if item_date is None:
+            raise RuntimeError('Unknown date key: %r' % item)
+        return item_date
+
+    def itemDisplayDate(self, item):
+        u""" display_date, 無ければstart_date 無ければNone """
+        return item.displayDate if isinstance(item, DumpedItem) else parseDisplayDate(item)
+
+    def itemStamp(self, item):
+        u""" 更新判定に使うitemの更新日時文字列を得る 無ければNone """
+        for key in ("update_datetime", "insert_datetime", "publishFromDateTime"):
+            if item.get(key):
+                return item[key]
+        return None
+
+    # --- incremental fetch cursor
+
+    def cursorReached(self, key, item):
+        u""" itemが前回までに取得済みならTrue
+
+        update_datetimeが変わった(更新された)itemは取得済みとしない
+        """
+        if not self.incremental:
+            return False
+        cur = self.cursors.get(key)
+        if cur is None or not cur["update_datetime"]:
+            return False
+        stamp = self.itemStamp(item)
+        return stamp is not None and stamp <= cur["update_datetime"]
+
+    def advanceCursor(self, key, item, item_date=None):
+        if item_date is None:
+            item_date = self.itemDate(item)
+        item_id = item.get("id", item.get("handoutId"))
+        self.cursors.advance(key, item_id, self.itemStamp(item), item_date.isoformat())
+
+    def cursorDate(self, key):
+        u""" keyのカーソルの日付 incrementalでない、カーソルが無い場合はNone """
+        if not self.incremental:
+            return None
+        cur = self.cursors.get(key)
+        if cur is None or not cur["date"]:
+            return None
+        return date.fromisoformat(cur["date"])
+
     def itemDateTime(self, item):
-        if "insert_datetime" in item:
-            item_dt = datetime.fromisoformat(item["insert_datetime"])
-        elif "update_datetime" in item:
-            item_dt = datetime.fromisoformat(item["update_datetime"])
-        else:
+        item_dt = item.dateTime if isinstance(item, DumpedItem) else parseItemDateTime(item)
+        if item_dt is None:
             raise RuntimeError('Unknown date key: %r' % item)
         return item_dt
 
@@ -287,27 +1647,45 @@ class Dumpmon(object):
         return self.getJson(url)
 
     def iterTimeLineItems(self, service_id, start=1, end=10000):
-        for i in range(start, end):
-            sleep(0.5)
-            resj = self.getTimeline(service_id, i)
+        key = "timeline/%s" % service_id
+        pages = self.iterPages(lambda i: self.getTimeline(service_id, i), range(start, end))
+        try:
+            yield from self.iterTimeLinePages(key, pages)
+        finally:
+            pages.close()
+
+    def iterTimeLinePages(self, key, pages):
+        u""" pagesの(ページ番号, timelineのjson)から日付範囲内で未取得のitemを返す """
+        for i, resj in pages:
+            reached = False
             for item in resj["data"]:
+                # 取得済みitemのあるページは最後まで見てから終了する
+                if self.cursorReached(key, item):
+                    reached = True
+                    continue
                 result = self.dateRangeTest(item)
                 if result == 1:
                     pass
                 elif result == 0:
+                    self.advanceCursor(key, item)
                     yield item
                 elif result == -1:
                     return
+            if reached:
+                log.info("Fetched item reached. Finish: %d" % i)
+                return
             if not resj["next_page"]:
                 print("LastPage Detected. Finish: %d" % i)
                 return
 
-    def fetchTimeline(self):
+    def fetchTimeline(self, onItem=None):
+        u""" timelineを取得して保存する
+
+        Args:
+            onItem (callable, optional): 保存したitemごとに onItem(service_id, item) を呼ぶ
+        """
         srvs = self.getServices()
         for service_id in srvs.keys():
-            tl_fdr = p.join(_DUMPDIR, srvs[service_id]["name"], "timeline")
-            if not p.isdir(tl_fdr):
-                os.makedirs(tl_fdr)
             for item in self.iterTimeLineItems(service_id):
                 if item["timeline_kind"] == "topics":
                     itemname = "%(display_date)s_%(id)s.json" % item
@@ -320,128 +1698,157 @@ class Dumpmon(object):
                 else:
                     print(item)
                     raise RuntimeError("unknown timeline_kind: %s" % item["timeline_kind"])
-                fn = p.join(tl_fdr, itemname)
-                self.dumpjson(fn, item)
+                self.dumpItem(service_id, "timeline", itemname, item)
+                if onItem is not None:
+                    onItem(service_id, item)
+            self.cursors.commit()
 
-    def iterDumpedTimeline(self, service_id=None):
+    def iterDumpedTimeline(self, service_id=None, s_date=None, e_date=None, cache=True):
+        u""" 保存したtimelineのitemを日付順に返す s_date, e_dateでファイルを開く前に絞り込む """
         srvs = self.getServices()
         for sid in srvs.keys():
             if service_id and sid != service_id:
                 continue
-            tl_fdr = p.join(_DUMPDIR, srvs[sid]["name"], "timeline")
-            for fn in os.listdir(tl_fdr):
-                item = self.loadjson(p.join(tl_fdr, fn))
-                yield item
+            yield from self.iterDumpedItems(sid, "timeline", s_date, e_date, cache)
 
     def downloadTimeline(self):
         log.debug("download")
+        self.runDownloads(self.iterTimelineDownloads())
 
-        def dlFileExists(fdr_name, fn_head):
-            for fn in os.listdir(fdr_name):
-                if fn.startswith(fn_head):
-                    return True
-
+    def iterTimelineDownloads(self):
+        u""" timelineの添付ファイルをダウンロードするjobを返すイテレータ """
         srvs = self.getServices()
         for sid in srvs.keys():
             log.debug("service: %s" % sid)
-
-            s_fdr = p.join(self.outputdir, srvs[sid]["name"])
-            for item in self.iterDumpedTimeline(service_id=sid):
+            for item in self.iterDumpedTimeline(sid, *self.dateRange()):
                 if self.dateRangeTest(item) != 0:
                     continue
-                if "file_url" not in item or item["file_url"] is None:
-                    continue
-                item_displaydate = date.fromisoformat(item["display_date"])
-                fdr_name = "%(YYYY-MM)s attachments" % {"YYYY-MM": item_displaydate.strftime("%Y-%m")}
-                log.debug("fdr_name: %s" % fdr_name)
-                fdr = p.join(s_fdr, fdr_name)
-                if not p.isdir(fdr):
-                    os.makedirs(fdr)
-                fn_head = sanitize_filename("%(display_date)s [%(title)s]" % item)
+                job = self.timelineDownloadJob(sid, item)
+                if job is not None:
+                    yield job
+
+    def timelineDownloadJob(self, sid, item):
+        u""" timelineのitemの添付ファイルをダウンロードするjob 添付が無いかダウンロード済みならNone """
+        if "file_url" not in item or item["file_url"] is None:
+            return None
+        key = "timeline/%s/%s" % (sid, item["id"])
+        if self.manifest.complete(key):
+            return None
+        s_fdr = p.join(self.outputdir, self.getServices()[sid]["name"])
+        item_displaydate = self.itemDate(item)
+        fdr_name = "%(YYYY-MM)s attachments" % {"YYYY-MM": item_displaydate.strftime("%Y-%m")}
+        log.debug("fdr_name: %s" % fdr_name)
+        fdr = p.join(s_fdr, fdr_name)
+        if not p.isdir(fdr):
+            os.makedirs(fdr)
+        fn_head = sanitize_filename("%(display_date)s [%(title)s]" % item)
 
-                if dlFileExists(fdr, fn_head):
-                    log.info("aleady exists. skip download: %s" % fn_head)
-                    continue
+        # manifestが無い時のダウンロード分は、最後に書く.txtの有無で判定する
+        if p.isfile(p.join(fdr, fn_head + ".txt")):
+            log.info("aleady exists. skip download: %s" % fn_head)
+            return None
 
-                url = _TOP_URL + item["file_url"]
-                res = self.get(url)
-                cd = res.headers['Content-Disposition']
-                dl_name = parseContnentDisporition(cd)
+        return lambda: self.downloadTimelineItem(item, fdr, fn_head, key)
 
-                fn = fn_head + " " + sanitize_filename(dl_name)
-                with open(p.join(fdr, fn), 'wb') as f:
-                    f.write(res.content)
+    def downloadTimelineItem(self, item, fdr, fn_head, key=None):
+        def finalName(headers):
+            cd = headers['Content-Disposition']
+            dl_name = parseContnentDisporition(cd)
+            return p.join(fdr, fn_head + " " + sanitize_filename(dl_name))
 
-                txt_fn = fn_head + ".txt"
-                with open(p.join(fdr, txt_fn), 'w', encoding="utf-8") as f:
-                    f.write("\n".join(self.makeNote_simpleContent(item)))
+        url = _TOP_URL + item["file_url"]
+        # 同じ日付とタイトルのitemが並行してダウンロードしても、途中のファイルは別にする
+        partfn = p.join(fdr, "%s_%s%s" % (fn_head, item["id"], _PART_EXT))
+        fn = self.download(url, partfn, finalName=finalName)
+
+        txt_fn = p.join(fdr, fn_head + ".txt")
+        with open(txt_fn, 'w', encoding="utf-8") as f:
+            f.write("\n".join(self.makeNote_simpleContent(item)))
+        if key:
+            self.recordDownload(key, [(fn, url), (txt_fn, None)])
 
     def fetchAlbum(self, service_id, album_id):
         # https://ps-api.codmon.com/api/v2/parent/albums/49193557?perpage=1000&id=49193557&__env__=myapp
 
-        srvs = self.getServices()
-        tl_fdr = p.join(_DUMPDIR, srvs[service_id]["name"], "album")
-        if not p.isdir(tl_fdr):
-            os.makedirs(tl_fdr)
         fmt = _API_URL + "/albums/%(id)s?perpage=1000&id=%(id)s"
         url = fmt % {"id": album_id}
         item = self.getJson(url)["data"]
         itemname = "%(display_date)s_%(id)s.json" % item
-        fn = p.join(tl_fdr, itemname)
-        self.dumpjson(fn, item)
+        self.dumpItem(service_id, "album", itemname, item)
         return item
 
     def downloadTimelinePhoto(self):
         log.debug("download photo")
+        self.runDownloads(self.iterTimelinePhotoDownloads())
 
-        def dlFileExists(fdr_name, fn_head):
-            for fn in os.listdir(fdr_name):
-                if fn.startswith(fn_head):
-                    return True
-
+    def iterTimelinePhotoDownloads(self):
+        u""" timelineのアルバムごとに写真をダウンロードするjobを返すイテレータ """
         srvs = self.getServices()
         for sid in srvs.keys():
             log.debug("service: %s" % sid)
-
-            s_fdr = p.join(self.outputdir, srvs[sid]["name"])
-            for item in self.iterDumpedTimeline(service_id=sid):
+            for item in self.iterDumpedTimeline(sid, *self.dateRange()):
                 if self.dateRangeTest(item) != 0:
                     continue
-                if "photos" not in item or item["photos"] is None:
-                    continue
-
-                item_displaydate = date.fromisoformat(item["display_date"])
-                fdr_name = "%(YYYY-MM-DD)s photos" % {"YYYY-MM-DD": item_displaydate.isoformat()}
-                log.debug("fdr_name: %s" % fdr_name)
-                fdr = p.join(s_fdr, fdr_name)
-                if not p.isdir(fdr):
-                    os.makedirs(fdr)
+                job = self.timelinePhotoJob(sid, item)
+                if job is not None:
+                    yield job
+
+    def timelinePhotoJob(self, sid, item):
+        u""" timelineのitemのアルバムの写真をダウンロードするjob 写真が無いかダウンロード済みならNone """
+        if "photos" not in item or item["photos"] is None:
+            return None
+        # 全写真がダウンロード済みならアルバムも取得しない
+        key = "album/%s/%s" % (sid, item["id"])
+        if self.manifest.complete(key):
+            return None
+
+        s_fdr = p.join(self.outputdir, self.getServices()[sid]["name"])
+        item_displaydate = self.itemDate(item)
+        fdr_name = "%(YYYY-MM-DD)s photos" % {"YYYY-MM-DD": item_displaydate.isoformat()}
+        log.debug("fdr_name: %s" % fdr_name)
+        fdr = p.join(s_fdr, fdr_name)
+        if not p.isdir(fdr):
+            os.makedirs(fdr)
+        return lambda: self.downloadAlbum(sid, item, fdr, key)
+
+    def downloadAlbum(self, sid, item, fdr, key=None):
+        u""" timelineのitemのアルバムの写真をすべてfdrにダウンロードする """
+        item_displaydate = self.itemDate(item)
+        # photos はtimelineにはすべての画像URLが含まれない
+        # albumsにアクセスしてjsonを得る
+        sub_item = self.fetchAlbum(sid, item["id"])
+        files = []
+        for p_item in sub_item["photos"]:
+            url = p_item["url"]
+            name = url.split("?")[0].split("/")[-1]
+            fn_base = "%(display_date)s_%(id)s_%(p_id)s[%(name)s]" % {
+                "display_date": item_displaydate.isoformat(),
+                "id": sub_item["id"],  # album id
+                "p_id": p_item["id"],
+                "name": name,
+            }
+            # 写真はjpegなので.jpgで存在を確認する
+            fn = p.join(fdr, fn_base + ".jpg")
+            if p.exists(fn):
+                log.info("aleady exists. skip download: %s" % fn)
+            else:
+                fn = self.downloadPhoto(url, fdr, fn_base)
+            files.append((fn, url))
+        if key:
+            self.recordDownload(key, files)
+
+    def downloadPhoto(self, url, fdr, fn_base):
+        u""" アルバムの写真をfdr/fn_base + 拡張子に保存する """
+        def finalName(headers):
+            ctype = headers["content-type"]
+            if ctype == "image/jpeg":
+                ext = ".jpg"
+            else:
+                log.warning("unknown albam photo content-type: %s %s" % (ctype, url))
+                ext = mimetypes.guess_extension(ctype) or ""
+            return p.join(fdr, fn_base + ext)
 
-                # photos はtimelineにはすべての画像URLが含まれない
-                # albumsにアクセスしてjsonを得る
-                sub_item = self.fetchAlbum(sid, item["id"])
-                for p_item in sub_item["photos"]:
-                    url = p_item["url"]
-                    res = self.get(url)
-                    ext = None
-                    if res.headers["content-type"] == "image/jpeg":
-                        ext = ".jpg"
-                    else:
-                        RuntimeError("unknown albam photo content-type: %s" % p_item["id"])
-                    name = url.split("?")[0].split("/")[-1]
-                    fn = "%(display_date)s_%(id)s_%(p_id)s[%(name)s]%(ext)s" % {
-                        "display_date": item_displaydate.isoformat(),
-                        "id": sub_item["id"],  # album id
-                        "p_id": p_item["id"],
-                        "name": name,
-                        "ext": ext
-                    }
-                    if p.exists(p.join(fdr, fn)):
-                        log.info("aleady exists. skip download: %s" % fn)
-                        continue
-
-                    with open(p.join(fdr, fn), 'wb') as f:
-                        f.write(res.content)
+        return self.download(url, p.join(fdr, fn_base + _PART_EXT), finalName=finalName)
 
     # --- handout
 
@@ -463,49 +1870,64 @@ class Dumpmon(object):
         return self.get(url, headers=headers)
 
     def iterHandsoutsPage(self):
-        u""" 資料室のリスト画面をページ事に取得していくイテレータ """
+        u""" 資料室のリスト画面をページ事に取得していくイテレータ 2ページ目からは先読みする """
         resj = self.getHandoutsPage().json()
         for handout in resj["handouts"]:
             yield handout
-        pages = resj["page"]["totalPages"]
-        for page in range(2, pages + 1):
-            resj = self.getHandoutsPage(page=page).json()
-            for handout in resj["handouts"]:
-                yield handout
+        totalPages = resj["page"]["totalPages"]
+        pages = self.iterPages(lambda page: self.getHandoutsPage(page=page).json(), range(2, totalPages + 1))
+        try:
+            for page, resj in pages:
+                for handout in resj["handouts"]:
+                    yield handout
+        finally:
+            pages.close()
 
     def iterHandouts(self):
         """ handouts(資料室) のリストを順に得る 範囲はself.s_date, self.e_dateの範囲 """
-        for item in self.iterHandsoutsPage():
-            hid = item["handoutId"]
-            result = self.dateRangeTest(item)
-            if result == 1:
-                pass
-            elif result == 0:
-                yield self.getHandout(hid).json()
-            elif result == -1:
-                return
+        def iterInRange():
+            for item in self.iterHandsoutsPage():
+                if self.cursorReached("handouts", item):
+                    log.info("Fetched handout reached.")
+                    return
+                result = self.dateRangeTest(item)
+                if result == 1:
+                    pass
+                elif result == 0:
+                    self.advanceCursor("handouts", item)
+                    yield item
+                elif result == -1:
+                    return
+
+        # 各資料の取得はワーカーで並列に行い、順番通りに返す
+        hids = (item["handoutId"] for item in iterInRange())
+        for res in self.iterMap(self.getHandout, hids):
+            yield res.json()
 
     def handoutDumpFolder(self):
-        fdr = p.join(_DUMPDIR, "handouts")
+        fdr = self.dumpFolder(None, "handouts")
         if not p.isdir(fdr):
             os.makedirs(fdr)
         return fdr
 
-    def fetchHandouts(self):
-        """ handouts(資料室) のリストを順に保存する 範囲はself.s_date, self.e_dateの範囲 """
-        fdr = self.handoutDumpFolder()
+    def fetchHandouts(self, onItem=None):
+        """ handouts(資料室) のリストを順に保存する 範囲はself.s_date, self.e_dateの範囲
+
+        Args:
+            onItem (callable, optional): 保存したitemごとに onItem(item) を呼ぶ
+        """
         for item in self.iterHandouts():
             isodt = item["publishFromDateTime"]
             disp_date = date.fromisoformat(isodt.split("T")[0])
             itemname = "%(date)s [%(title)s].json" % {"date": disp_date, "title": item["title"]}
-            fn = p.join(fdr, itemname)
-            self.dumpjson(fn, item)
+            self.dumpItem(None, "handouts", itemname, item)
+            if onItem is not None:
+                onItem(item)
+        self.cursors.commit()
 
     def iterDumpedHandouts(self):
-        u""" ダンプ済みhandoutを返す 範囲はself.s_date, self.e_dateの範囲 順不同"""
-        fdr = self.handoutDumpFolder()
-        for fn in os.listdir(fdr):
-            item = self.loadjson(p.join(fdr, fn))
+        u""" ダンプ済みhandoutを返す 範囲はself.s_date, self.e_dateの範囲 日付順"""
+        for item in self.iterDumpedItems(None, "handouts", *self.dateRange()):
             if self.dateRangeTest(item) == 0:
                 yield item
 
@@ -514,9 +1936,13 @@ class Dumpmon(object):
 
 
     def downloadHandout(self, item):
+        key = "handout/%s [%s]" % (item["publishFromDateTime"], item["title"])
+        if self.manifest.complete(key):
+            return
         fdr = self.handoutDownloadFolder()  # p.join(self.outputdir, "資料室")
         if not p.isdir(fdr):
             os.makedirs(fdr)
+        files = []
         for i, att in enumerate(item["attachments"]):
             url = att["url"]
             itemname = "%(_date)s [%(title)s][%(count)s] %(filename)s" % dict(
@@ -526,17 +1952,18 @@ class Dumpmon(object):
                 filename=urllib.parse.unquote(att["fileName"]),
             )
             fn = p.join(fdr, itemname)
+            files.append((fn, url))
             if p.isfile(fn):
                 log.info("aleady downloaded: %s" % itemname)
                 continue
-            res = self.get(url)
-            with open(fn, 'wb') as f:
-                f.write(res.content)
+            # 同じ日付とタイトルのhandoutが並行してダウンロードしても、途中のファイルは別にする
+            self.download(url, "%s_%s%s" % (fn, item["handoutId"], _PART_EXT), finalName=lambda headers, fn=fn: fn)
+        self.recordDownload(key, files)
 
     def downloadAllHandout(self):
         u""" start date, end dateの範囲内のhandoutをダウンロードする """
-        for item in self.iterDumpedHandouts():
-            self.downloadHandout(item)
+        self.runDownloads(
+            lambda item=item: self.downloadHandout(item) for item in self.iterDumpedHandouts())
 
     # --- children
 
@@ -567,119 +1994,135 @@ class Dumpmon(object):
                 yield rel
 
     def srcIdFromMemId(self, memId):
-        u""" member_id から service_id を得る """
-        for cmr in self.iterCMR():
-            if cmr["member_id"] == memId:
-                return cmr["service_id"]
+        u""" member_id から service_id を得る 索引は初めて使うときに作る """
+        if self.memberServices is None:
+            self.memberServices = {}
+            for cmr in self.iterCMR():
+                self.memberServices.setdefault(cmr["member_id"], cmr["service_id"])
+        return self.memberServices.get(memId)
 
     # -- comments
 
+    def memberDateRange(self, cmr, key=None):
+        u""" child_member_relationの取得範囲(start, end)を得る
+
+        self.s_date, self.e_dateが無ければ在籍期間(退園日または今日〜入園日)を使う
+        keyのカーソルがあれば、カーソルの日付より古い日は取得しない
+        """
+        o_date = cmr["member_open_date"]
+        c_date = cmr["member_close_date"]
+        start = self.s_date
+        end = self.e_date
+        if start is None:
+            if c_date:
+                start = date.fromisoformat(c_date)
+            else:
+                start = date.today()
+        if end is None:
+            end = date.fromisoformat(o_date)
+        c_date = self.cursorDate(key) if key else None
+        if c_date:
+            older, newer = sorted([start, end])
+            older = min(max(older, c_date), newer)
+            start, end = (older, newer) if start <= end else (newer, older)
+        return start, end
+
+    def getWindowJson(self, fmt, params, window):
+        u""" 期間windowのデータを取得する
+
+        件数がページ上限に達したら取りこぼしがあるので、期間を二分割して取り直す
+
+        Returns:
+            list: 取得したitemのリスト
+        """
+        lo, hi = window
+        url = fmt % dictmerge(params, {
+            "s_date": lo.isoformat(),
+            "e_date": hi.isoformat(),
+            "perpage": _PAGE_CAP,
+        })
+        resj = self.getJson(url)
+        data = resj["data"]
+        if (len(data) >= _PAGE_CAP or resj.get("next_page")) and lo < hi:
+            log.debug("split window: %s %s" % (lo, hi))
+            mid = lo + timedelta((hi - lo).days // 2)
+            # 新しい期間から順に返す
+            return (self.getWindowJson(fmt, params, (mid + timedelta(1), hi))
+                    + self.getWindowJson(fmt, params, (lo, mid)))
+        return data
+
+    def iterWindowedItems(self, fmt, params, start, end, key):
+        u""" start〜endをself.windowの期間ごとに取得してitemを返すイテレータ
+
+        返したitemでkeyのカーソルを進める
+        """
+        windows = dwindows(start, end, _WINDOW_DAYS[self.window])
+        for data in self.iterMap(lambda w: self.getWindowJson(fmt, params, w), windows):
+            for item in data:
+                result = self.dateRangeTest(item)
+                if result == 1:
+                    pass
+                elif result == 0:
+                    self.advanceCursor(key, item)
+                    yield item
+                elif result == -1:
+                    return
+
     def iterComments(self, service_id):
         """
         """
+        fmt = (
+            "https://ps-api.codmon.com/api/v2/parent/comments/"
+            "?search_kind=2"
+            "&relation_id=%(relation_id)d"
+            "&relation_kind=2"
+            "&search_start_display_date=%(s_date)s"
+            "&search_end_display_date=%(e_date)s"
+            "&perpage=%(perpage)d"
+            "&__env__=myapp"
+        )
         for cmr in self.iterCMR(service_id):
-            o_date = cmr["member_open_date"]
-            c_date = cmr["member_close_date"]
-            start = self.s_date
-            end = self.e_date
-            if start is None:
-                if c_date:
-                    start = date.fromisoformat(c_date)
-                else:
-                    start = date.today()
-            if end is None:
-                end = date.fromisoformat(o_date)
-
-            fmt = (
-                "https://ps-api.codmon.com/api/v2/parent/comments/"
-                "?search_kind=2"
-                "&relation_id=%(relation_id)d"
-                "&relation_kind=2"
-                "&search_start_display_date=%(s_date)s"
-                "&search_end_display_date=%(s_date)s"
-                "&__env__=myapp"
-            )
-
-            for s_date in drange(start, end):
-                mem = cmr["member_id"]
-                url = fmt % {
-                    "relation_id": int(mem),
-                    "s_date": s_date.isoformat(),
-                }
-                resj = self.getJson(url)
-                for item in resj["data"]:
-                    result = self.dateRangeTest(item)
-                    if result == 1:
-                        pass
-                    elif result == 0:
-                        yield item
-                    elif result == -1:
-                        return
+            key = "comments/%s" % cmr["member_id"]
+            start, end = self.memberDateRange(cmr, key)
+            params = {"relation_id": int(cmr["member_id"])}
+            yield from self.iterWindowedItems(fmt, params, start, end, key)
 
     def fetchComments(self):
         u""" Comments(保護者からの連絡)を取得して保存する
         """
         srvs = self.getServices()
         for service_id in srvs.keys():
-            cmt_fdr = p.join(_DUMPDIR, srvs[service_id]["name"], "comments")
-            if not p.isdir(cmt_fdr):
-                os.makedirs(cmt_fdr)
             for item in self.iterComments(service_id):
                 itemname = "%(display_date)s_%(id)s.json" % item
-                fn = p.join(cmt_fdr, itemname)
-                self.dumpjson(fn, item)
+                self.dumpItem(service_id, "comments", itemname, item)
+        self.cursors.commit()
 
-    def iterDumpedComments(self, service_id=None):
+    def iterDumpedComments(self, service_id=None, s_date=None, e_date=None, cache=True):
+        u""" 保存したcommentsのitemを日付順に返す s_date, e_dateでファイルを開く前に絞り込む """
         srvs = self.getServices()
         for sid in srvs.keys():
             if service_id and sid != service_id:
                 continue
-            fdr = p.join(_DUMPDIR, srvs[sid]["name"], "comments")
-            for fn in os.listdir(fdr):
-                item = self.loadjson(p.join(fdr, fn))
-                yield item
+            yield from self.iterDumpedItems(sid, "comments", s_date, e_date, cache)
 
     # --- contact_responses
 
     def iterContactResponses(self, service_id):
+        fmt = (
+            "https://ps-api.codmon.com/api/v2/parent/contact_responses/"
+            "?member_id=%(member_id)s"
+            "&search_start_display_date=%(s_date)s"
+            "&search_end_display_date=%(e_date)s"
+            "&search_status_id[]=1"
+            "&search_status_id[]=2"
+            "&search_status_id[]=3"
+            "&perpage=%(perpage)d"
+            "&__env__=myapp")
         for cmr in self.iterCMR(service_id):
-            o_date = cmr["member_open_date"]
-            c_date = cmr["member_close_date"]
-            start = self.s_date
-            end = self.e_date
-            if start is None:
-                if c_date:
-                    start = date.fromisoformat(c_date)
-                else:
-                    start = date.today()
-            if end is None:
-                end = date.fromisoformat(o_date)
-            fmt = (
-                "https://ps-api.codmon.com/api/v2/parent/contact_responses/"
-                "?member_id=%(member_id)s"
-                "&search_start_display_date=%(s_date)s"
-                "&search_end_display_date=%(s_date)s"
-                "&search_status_id[]=1"
-                "&search_status_id[]=2"
-                "&search_status_id[]=3"
-                "&perpage=1000"
-                "&__env__=myapp")
-
-            for s_date in drange(start, end):
-                mem = cmr["member_id"]
-                url = fmt % {
-                    "member_id": int(mem),
-                    "s_date": s_date.isoformat(),
-                }
-                resj = self.getJson(url)
-                for item in resj["data"]:
-                    result = self.dateRangeTest(item)
-                    if result == 1:
-                        pass
-                    elif result == 0:
-                        yield item
-                    elif result == -1:
-                        return
+            key = "contact_responses/%s" % cmr["member_id"]
+            start, end = self.memberDateRange(cmr, key)
+            params = {"member_id": int(cmr["member_id"])}
+            yield from self.iterWindowedItems(fmt, params, start, end, key)
 
     def fetchContactResponses(self, service_id=None):
         u"""_ContactResponses(保護者からの遅刻・欠席連絡)を取得して保存する
@@ -691,23 +2134,18 @@ class Dumpmon(object):
         for sid in srvs.keys():
             if service_id and sid != service_id:
                 continue
-            fdr = p.join(_DUMPDIR, srvs[sid]["name"], "contact_responses")
-            if not p.isdir(fdr):
-                os.makedirs(fdr)
             for item in self.iterContactResponses(sid):
                 itemname = "%(display_date)s_%(id)s.json" % item
-                fn = p.join(fdr, itemname)
-                self.dumpjson(fn, item)
+                self.dumpItem(sid, "contact_responses", itemname, item)
+        self.cursors.commit()
 
-    def iterDumpedContactResponses(self, service_id=None):
+    def iterDumpedContactResponses(self, service_id=None, s_date=None, e_date=None, cache=True):
+        u""" 保存したcontact_responsesのitemを日付順に返す s_date, e_dateでファイルを開く前に絞り込む """
         srvs = self.getServices()
         for sid in srvs.keys():
             if service_id and sid != service_id:
                 continue
-            fdr = p.join(_DUMPDIR, srvs[sid]["name"], "contact_responses")
-            for fn in os.listdir(fdr):
-                item = self.loadjson(p.join(fdr, fn))
-                yield item
+            yield from self.iterDumpedItems(sid, "contact_responses", s_date, e_date, cache)
 
     def iterDumpedTemparture(self, service_id=None):
         srvs = self.getServices()
@@ -718,12 +2156,12 @@ class Dumpmon(object):
                 if "content" not in item:
                     continue
                 try:
-                    content = json.loads(item["content"])
+                    content = self.itemContent(item)
                 except json.JSONDecodeError:
                     continue
                 if "tempratures" in content:
                     for tempitem in content["tempratures"]:
-                        itemdate = date.fromisoformat(item["display_date"])
+                        itemdate = self.itemDate(item)
                         temptime = time.fromisoformat(tempitem["temprature_time"])
                         tempdatetime = datetime.combine(itemdate, temptime)
                         yield (tempdatetime, tempitem["temprature"])
@@ -739,7 +2177,7 @@ class Dumpmon(object):
                 if "content" not in item or item["content"] is None:
                     continue
                 try:
-                    content = json.loads(item["content"])
+                    content = self.itemContent(item)
                 except json.JSONDecodeError:
                     continue
                 if "sleepings" in content:
@@ -757,18 +2195,70 @@ class Dumpmon(object):
 
     def fetchAttendances(self):
         """ 登園時間情報を取得
+
+        月ごとに start_date, end_date を指定して取得し、dump/attendances/YYYY-MM.json に保存します。
+        範囲指定があればその月を、なければカーソルの月から今月までを取り直します。
+        どちらもなければ期間を指定せずにすべて取得して月ごとに分けます。
+        月ごとのファイルをまとめたものを attendances.json に書き出します。
+        月ごとのファイルが無ければ、先に既存の attendances.json を月ごとに分けておきます。
         """
         # https://ps-api.codmon.com/api/v2/parent/attendances/?start_date=2023-01-01&end_date=2023-01-31&__env__=myapp
         url = _API_URL + "/attendances"
-        fn = p.join(_DUMPDIR, "attendances.json")
-        resj = self.getJson(url)
-        self.dumpjson(fn, resj["data"])
+        fdr = p.join(_DUMPDIR, "attendances")
+        if not p.isdir(fdr):
+            os.makedirs(fdr)
+        self.splitDumpedAttendances(fdr)
+        s_date, e_date = self.dateRange()
+        if s_date is None:
+            s_date, e_date = self.cursorDate("attendances"), date.today()
+        months = {}
+        if s_date is None:
+            for att in self.getJson(url)["data"]:
+                months.setdefault(att["start_date"][:7], []).append(att)
+        else:
+            windows = mwindows(s_date, e_date)
+            urls = [url + "?start_date=%s&end_date=%s" % (ms.isoformat(), me.isoformat()) for ms, me in windows]
+            for (ms, me), resj in zip(windows, self.iterGetJson(urls)):
+                months[ms.strftime("%Y-%m")] = resj["data"]
+        for ym, atts in months.items():
+            self.dumpjson(p.join(fdr, "%s.json" % ym), atts)
+            for att in atts:
+                self.advanceCursor("attendances", att, date.fromisoformat(att["start_date"]))
+        self.cursors.commit()
+
+        atts = []
+        for fn in sorted(os.listdir(fdr)):
+            if fn.endswith(".json"):
+                atts.extend(self.loadjson(p.join(fdr, fn)))
+        self.dumpjson(p.join(_DUMPDIR, "attendances.json"), atts)
+        self.attendances = None
+
+    def splitDumpedAttendances(self, fdr):
+        u""" 月ごとのファイルが1つも無ければ、既存の attendances.json を fdr/YYYY-MM.json に分ける """
+        if any(fn.endswith(".json") for fn in os.listdir(fdr)):
+            return
+        if not p.isfile(p.join(_DUMPDIR, "attendances.json")):
+            return
+        months = {}
+        for att in self.loadDumpedAttendances():
+            months.setdefault(att["start_date"][:7], []).append(att)
+        for ym, atts in months.items():
+            self.dumpjson(p.join(fdr, "%s.json" % ym), atts)
 
     def loadDumpedAttendances(self):
         fn = p.join(_DUMPDIR, "attendances.json")
         atts = self.loadjson(fn)
         return atts
 
+    def attendanceIndex(self):
+        u""" 日付("YYYY-MM-DD")ごとの登園時間情報 保存したものを初めて使うときに1回だけ読む """
+        if self.attendances is None:
+            self.attendances = {}
+            if p.isfile(p.join(_DUMPDIR, "attendances.json")):
+                for att in self.loadDumpedAttendances():
+                    self.attendances.setdefault(att["start_date"], att)
+        return self.attendances
+
     # --
     # --- communication notebook ---
     # --
@@ -814,108 +2304,174 @@ class Dumpmon(object):
 
         return years, months, days
     
-    def makenote(self):
+    def makenote(self, processes=1):
+        u""" 連絡帳を月ごとのrstファイルに書き出す
+
+        timeline, comment, contactresponseのitemをそれぞれ日時順に読み出してマージし、
+        1か月分がそろうたびに書き出すので、メモリには1か月分のitemしか持ちません。
+        月ごとに材料のitem(idと更新日時)の指紋を記録しておき、
+        指紋が変わった月だけ作り直します。変わっていない月のファイルには触りません。
+
+        Args:
+            processes (int, optional): 2以上なら月ごとの生成をプロセスプールで並列に行う
+                出力は1プロセスの場合と同じです。 Defaults to 1.
+        """
+        srvs = self.getServices()
+        fingerprints = self.loadNoteFingerprints()
+        executor = processPool(processes)
+        try:
+            for sid in srvs.keys():
+                self.makeNoteService(sid, srvs[sid]["name"], fingerprints, executor, processes * 2)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        self.saveNoteFingerprints(fingerprints)
+        self.make_index()
+
+    def makeNoteService(self, sid, sname, fingerprints, executor=None, width=None):
+        u""" サービスの連絡帳のうち、材料が変わった月を書き出す
+
+        executorがあれば月ごとの生成をそこで並列に行い、月の順に書き出す
+        """
+        # 日時順にitemをマージする 全期間を1回読むだけなのでキャッシュには入れない
+        items = heapq.merge(
+            self.iterNoteItems("timeline", self.iterDumpedTimeline(service_id=sid, cache=False)),
+            self.iterNoteItems("comment", self.iterDumpedComments(service_id=sid, cache=False)),
+            self.iterNoteItems("contactresponse", self.iterDumpedContactResponses(service_id=sid, cache=False)),
+            key=lambda x: x[1:3])
+
+        # serviceごとのフォルダ
+        fdr = p.join(self.outputdir, sname)
+        if not p.isdir(fdr):
+            os.makedirs(fdr)
+
+        # 作り直す月を順に返す 書き出しに使う情報はmetaに積む
+        meta = collections.deque()
+
+        def iterJobs():
+            for yyyymm, monthItems in itertools.groupby(items, key=lambda x: x[1].strftime("%Y-%m")):
+                monthItems = list(monthItems)
+                key = "%s/%s" % (sid, yyyymm)
+                fn = p.join(fdr, "%s note.rst" % yyyymm)
+                fp = self.noteFingerprint(sname, monthItems)
+                if fingerprints.get(key) == fp and p.isfile(fn):
+                    continue
+                log.info("makenote: %s %s" % (sname, yyyymm))
+                meta.append((key, fn, fp))
+                yield (sname, monthItems)
+
+        if executor is None:
+            texts = map(self.renderNoteMonth, iterJobs())
+        else:
+            texts = self.iterMap(self.renderNoteMonth, iterJobs(), pool=executor, width=width)
+        for txt in texts:
+            key, fn, fp = meta.popleft()
+            with open(fn, 'w', encoding="utf-8") as f:
+                f.write(txt)
+            fingerprints[key] = fp
+
+    def renderNoteMonth(self, job):
+        u""" (サービス名, 1か月分のitems)から連絡帳のテキストを作る プロセスプールから呼ばれる """
+        sname, items = job
+        return "\n".join(self.makeNoteMonth(sname, items))
+
+    def iterNoteItems(self, category, items):
+        u""" 連絡帳の材料として(category, display_date, datetime, item)を日時順に返す
+
+        itemsはダンプの日付順(ファイル名順)なので、同じ日付のitemだけを溜めて並べ替える
+        display_dateが無いitemは、ファイル名と同じくstart_date、それも無ければ作成日時の日付を使う
+        """
+        def noteItem(item):
+            date_time = self.itemDateTime(item)
+            display_date = self.itemDisplayDate(item) or date_time.date()
+            return (category, display_date, date_time, item)
+
+        for display_date, dayItems in itertools.groupby(map(noteItem, items), key=lambda x: x[1]):
+            yield from sorted(dayItems, key=lambda x: x[2])
+
+    def makeNoteMonth(self, sname, items):
+        u""" 1か月分の連絡帳の行を作る
+
+        Args:
+            sname (str): サービス名
+            items (list): (category, display_date, datetime, item)の日時順のリスト
+
+        Returns:
+            list: 行のリスト
+        """
         itemProcMap = {
             "timeline": self.procTimeLineItem,
             "comment": self.procCommentItem,
             #"contactresponse": self.procContactResponseItem
         }
-        self.fetchAttendances()  # debug
-        atts = self.loadDumpedAttendances()
-        srvs = self.getServices()
-        allLines = {}
-        for sid in srvs.keys():
-            allLines[sid] = {}
-
-            def getItems(items, category, itemsGetFunc):
-                for item in itemsGetFunc(service_id=sid):
-                    date_time = self.itemDateTime(item)
-                    if "display_date" in item:
-                        display_date = date.fromisoformat(item["display_date"])
-                    else:
-                        display_date = date_time.date()
-                    items.append((category, display_date, date_time, item))
-            # itemを収集する
-            items = []
-            getItems(items, "timeline", self.iterDumpedTimeline)
-            getItems(items, "comment", self.iterDumpedComments)
-            getItems(items, "contactresponse", self.iterDumpedContactResponses)
-            # itemsをDisplayDateでソートする
-            items = sorted(items, key=lambda x: x[1:3])
-
-            # serviceごとのフォルダ
-            fdr = p.join(self.outputdir, srvs[sid]["name"])
-            if not p.isdir(fdr):
-                os.makedirs(fdr)
-
-            # 処理中の日付
-            cur_date = None
-
-            # 時系列にitemsを処理していく
-            for item_src, item_displaydate, item_datetime, item in items:
-                yyyymm = item_displaydate.strftime("%Y-%m")
-                # month header
-                # 月ごとにファイルをわけそのヘッダを作る
-                # 新しい月を検出したら実行
-                if yyyymm not in allLines[sid]:
-                    title = "%s %s" % (srvs[sid]["name"], item_displaydate.strftime("%Y年%m月"))
-                    line = "\n%(line)s\n%(title)s\n%(line)s\n" % {"title": title, "line": "=" * width(title)}
-                    allLines[sid][yyyymm] = [line]
-                # date demiliter
-                if cur_date is None or cur_date != item_displaydate:
-                    cur_date = item_displaydate
-                    title = "%s" % item_displaydate.strftime("%m月%d日")
-                    child_birth_date = datetime(2021, 3, 12)
-                    cur_datetime = datetime.combine(cur_date, datetime.min.time())
-
-                    months, weeks, days = self.calculate_age(child_birth_date, cur_datetime)
-                    title += "    %d歳%dヶ月" % (months, weeks)
-                    line = "\n%s\n%s\n" % (title, "=" * width(title))
-                    allLines[sid][yyyymm].append(line)
-                    # # 登園時間
-                    # attLine = self.make_attendance(atts, cur_date)
-                    # if attLine:
-                    #     allLines[sid][yyyymm].append(attLine)
-
-                # itemの種類ごとに内容を生成する
-                itemProcFunc = itemProcMap.get(item_src)
-                if itemProcFunc:
-                    lines = itemProcFunc(item)
-                    if lines:
-                        allLines[sid][yyyymm].extend(lines)
-
-            # footer
-            for yyyymm in allLines[sid].keys():
-                pass
+        # month header
+        # 月ごとにファイルをわけそのヘッダを作る
+        item_displaydate = items[0][1]
+        title = "%s %s" % (sname, item_displaydate.strftime("%Y年%m月"))
+        line = "\n%(line)s\n%(title)s\n%(line)s\n" % {"title": title, "line": "=" * width(title)}
+        allLines = [line]
+
+        # 処理中の日付
+        cur_date = None
+
+        # 時系列にitemsを処理していく
+        for item_src, item_displaydate, item_datetime, item in items:
+            # date demiliter
+            if cur_date is None or cur_date != item_displaydate:
+                cur_date = item_displaydate
+                title = "%s" % item_displaydate.strftime("%m月%d日")
+                child_birth_date = datetime(2021, 3, 12)
+                cur_datetime = datetime.combine(cur_date, datetime.min.time())
+
+                months, weeks, days = self.calculate_age(child_birth_date, cur_datetime)
+                title += "    %d歳%dヶ月" % (months, weeks)
+                line = "\n%s\n%s\n" % (title, "=" * width(title))
+                allLines.append(line)
+                # # 登園時間
+                # attLine = self.make_attendance(self.attendanceIndex(), cur_date)
+                # if attLine:
+                #     allLines.append(attLine)
+
+            # itemの種類ごとに内容を生成する
+            itemProcFunc = itemProcMap.get(item_src)
+            if itemProcFunc:
+                lines = itemProcFunc(item)
+                if lines:
+                    allLines.extend(lines)
+        return allLines
+
+    def noteFingerprint(self, sname, items):
+        u""" 1か月分の連絡帳の材料の指紋 itemの種類, id, 更新日時から作る """
+        h = hashlib.sha1()
+        h.update(("%d %s\n" % (_NOTE_VERSION, sname)).encode("utf-8"))
+        for item_src, item_displaydate, item_datetime, item in items:
+            h.update(("%s %s %s %s\n" % (
+                item_src, item_displaydate, item.get("id"), self.itemStamp(item))).encode("utf-8"))
+        return h.hexdigest()
+
+    def loadNoteFingerprints(self):
+        fn = p.join(self.outputdir, "_notes.json")
+        if p.isfile(fn):
+            return self.loadjson(fn)
+        return {}
 
-            # write to file
-            for yyyymm in allLines[sid].keys():
-                fn = "%s note.rst" % yyyymm
-                with open(p.join(fdr, fn), 'w', encoding="utf-8") as f:
-                    txt = "\n".join(allLines[sid][yyyymm])
-                    f.write(txt)
-        self.make_index()
+    def saveNoteFingerprints(self, fingerprints):
+        self.dumpjson(p.join(self.outputdir, "_notes.json"), fingerprints)
 
     def make_attendance(self, atts, att_date):
         """ 登園時間
 
         Args:
-            atts (list): attendance data from dumped json
+            atts (dict): attendance data by date from attendanceIndex()
             att_date (date): date
         """
-        def find_date(atts, att_date):
-            s_att_date = att_date.isoformat()
-            for att in atts:
-                if att["start_date"] == s_att_date:
-                    return att
-
         def toStr(att, key):
             if key in att and att[key]:
                 t = time.fromisoformat(att[key])
                 return t.strftime("%H:%M")
             else:
                 return ""
-        att = find_date(atts, att_date)
+        att = atts.get(att_date.isoformat())
         if att:
             return "%s 〜 %s" % (toStr(att, "start_time"), toStr(att, "end_time"))
 
@@ -967,6 +2523,11 @@ class Dumpmon(object):
         else:
             lines.append(tochead)
             lines.extend(toc_lines)
+        # 変わっていなければ書かない (Sphinxに変更とみなされないように)
+        if p.isfile(index_file):
+            with open(index_file, 'r', encoding="utf-8") as f:
+                if f.read() == "".join(lines):
+                    return
         with open(index_file, 'w', encoding="utf-8") as f:
             f.writelines(lines)
 
@@ -985,7 +2546,7 @@ class Dumpmon(object):
         assert item["kind"] == "4"
         indent = " " * 4
 
-        c = json.loads(item["content"])
+        c = self.itemContent(item)
         memo = re.sub(r"<.*?>", "\n", c["memo"])
         lines = ["\n"]
 
@@ -999,7 +2560,7 @@ class Dumpmon(object):
         #lines.append("%(title)s\n%(line)s" % {"title": title, "line": "-" * width(title)})
 
         for line in memo.split("\n"):
-            wrappedLines = [x for x in textwrap.wrap(line, width=30) if x]
+            wrappedLines = wrap(line, _WRAP_WIDTH)
             lines.extend(wrappedLines)
             lines.append("\n")
         memo = "\n".join(lines)
@@ -1075,7 +2636,7 @@ class Dumpmon(object):
     def procCommentItem(self, item):
         kind = item["kind"]
         if kind == "2":  # 連絡帳（保護者）
-            content = json.loads(item["content"])
+            content = self.itemContent(item)
             lines = ["\n"]
 
             _time = self.itemDateTime(item).strftime("%H:%M")
@@ -1158,10 +2719,20 @@ class Dumpmon(object):
         # DBG: lines.insert(0, "\n- item: ContactResponse\n")
         return lines
 
-    def makeSleep(self):
+    def makeSleep(self, parmin=_SLEEP_PARMIN):
+        u""" 園での午睡をsleepings.jsonに、午睡と登園時間をparmin分ごとの表にしてsleep.csvに書き出す
+
+        sleep.csvの記号は piyo.py と同じで、午睡は"x"、登園中は"t"を付けます。
+        """
         srvs = self.getServices()
+        attendances = {}
+        for ymd, att in self.attendanceIndex().items():
+            if att.get("start_time") and att.get("end_time"):
+                attendances[ymd] = [
+                    [int(x) for x in att["start_time"].split(":")[:2]],
+                    [int(x) for x in att["end_time"].split(":")[:2]],
+                ]
 
-        allLines = {}
         for sid in srvs.keys():
             fdr = p.join(self.outputdir, srvs[sid]["name"])
             if not p.isdir(fdr):
@@ -1171,6 +2742,12 @@ class Dumpmon(object):
                 for display_date, slps in self.iterDumpedSleepings(sid):
                     data[display_date] = list(slps)
                 json.dump(data, f, ensure_ascii=False, indent=4)
+            with open(p.join(fdr, "sleep.csv"), "w", encoding="utf-8") as f:
+                f.write(",".join(["", "", ""] + sleepGridHeader(parmin)) + "\n")
+                for display_date in sorted(data.keys()):
+                    slps = [((int(sh), int(sm)), (int(eh), int(em))) for (sh, sm), (eh, em) in data[display_date]]
+                    flags = sleepGrid([], slps, attendances.get(display_date), parmin=parmin)
+                    f.write(",".join([display_date, "", display_date[8:10].lstrip("0")] + flags) + "\n")
 
     def makeTouen(self):
         srvs = self.getServices()
@@ -1186,6 +2763,101 @@ class Dumpmon(object):
                     data[display_date] = list(slps)
                 json.dump(data, f, ensure_ascii=False, indent=4)
 
+    # --- analytics
+
+    def iterAnalyticsRows(self):
+        u""" 体温、午睡、登園時間、機嫌や食事などを(表の名前, 行)で返す
+
+        サービスごとにtimelineとcommentのダンプを1回だけ読み、1つのitemから全部の表の行を取り出します。
+        行の列は_ANALYTICS_TABLESの順です。
+        """
+        srvs = self.getServices()
+        for sid in srvs.keys():
+            items = itertools.chain(
+                (("timeline", x) for x in self.iterDumpedTimeline(service_id=sid)),
+                (("comment", x) for x in self.iterDumpedComments(service_id=sid)))
+            for src, item in items:
+                if not item.get("content"):
+                    continue
+                try:
+                    content = self.itemContent(item)
+                except json.JSONDecodeError:
+                    continue
+                if not isinstance(content, dict):
+                    continue
+                item_date = self.itemDate(item)
+
+                # 園の連絡帳は"tempratures"に複数、保護者の連絡帳は"temprature"に1つ
+                temps = list(content.get("tempratures") or [])
+                if content.get("temprature"):
+                    temps.append(content)
+                for temp in temps:
+                    t = parseTime(temp.get("temprature_time"))
+                    yield "temperatures", (
+                        sid, src, item_date, datetime.combine(item_date, t) if t else None,
+                        parseFloat(temp.get("temprature")))
+
+                for rng in (content.get("sleepings") or "").split("\n"):
+                    m = re.match(r'(\d+):(\d+)~(\d+):(\d+)', rng)
+                    if m and int(m.group(1)) < 24 and int(m.group(3)) < 24:
+                        sh, sm, eh, em = [int(x) for x in m.groups()]
+                        yield "sleeps", (
+                            sid, item_date, time(sh, sm), time(eh, em), (eh * 60 + em - sh * 60 - sm) % (24 * 60))
+
+                if any(content.get(key) for key in _CONDITION_KEYS):
+                    yield "conditions", (sid, src, item_date, self.itemDateTime(item)) + tuple(
+                        content.get(key) for key in _CONDITION_KEYS)
+
+        for ymd, att in sorted(self.attendanceIndex().items()):
+            s = parseTime(att.get("start_time"))
+            e = parseTime(att.get("end_time"))
+            minutes = (e.hour * 60 + e.minute - s.hour * 60 - s.minute) if s and e else None
+            yield "attendances", (date.fromisoformat(ymd), s, e, minutes)
+
+    def exportAnalytics(self, fmt="csv"):
+        u""" 体温、午睡、登園時間、機嫌や食事を型のついた表にしてoutputdir/_analyticsに書き出す
+
+        ダンプを1回なめて列ごとに集め、表ごとに1つのファイルにします。
+        csvは列の型をschema.jsonに書きます。parquetにはpyarrowが必要です。
+
+        Args:
+            fmt (str, optional): "csv" または "parquet" Defaults to "csv".
+        """
+        if fmt not in _ANALYTICS_FORMATS:
+            raise ValueError("unknown analytics format: %r" % fmt)
+        columns = {name: [[] for x in cols] for name, cols in _ANALYTICS_TABLES.items()}
+        for name, row in self.iterAnalyticsRows():
+            for col, value in zip(columns[name], row):
+                col.append(value)
+
+        fdr = p.join(self.outputdir, "_analytics")
+        if not p.isdir(fdr):
+            os.makedirs(fdr)
+        if fmt == "parquet":
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            types = {
+                "int64": pa.int64(), "float64": pa.float64(), "string": pa.string(),
+                "date": pa.date32(), "time": pa.time32("s"), "timestamp": pa.timestamp("s")}
+            for name, cols in _ANALYTICS_TABLES.items():
+                table = pa.table({
+                    c: pa.array([analyticsValue(x, t) for x in values], type=types[t])
+                    for (c, t), values in zip(cols, columns[name])})
+                pq.write_table(table, p.join(fdr, "%s.parquet" % name))
+        else:
+            for name, cols in _ANALYTICS_TABLES.items():
+                with open(p.join(fdr, "%s.csv" % name), "w", encoding="utf-8", newline="") as f:
+                    writer = csv.writer(f)
+                    writer.writerow([c for c, t in cols])
+                    writer.writerows(zip(*[
+                        [csvValue(analyticsValue(x, t)) for x in values]
+                        for (c, t), values in zip(cols, columns[name])]))
+            self.dumpjson(p.join(fdr, "schema.json"), {
+                name: {"columns": [list(x) for x in cols], "rows": len(columns[name][0])}
+                for name, cols in _ANALYTICS_TABLES.items()})
+        for name in _ANALYTICS_TABLES:
+            log.info("analytics: %s %d rows" % (name, len(columns[name][0])))
+
 
 # --- util
 
@@ -1227,6 +2899,175 @@ def drange(s: date, e: date, includeEndDate: bool = True) -> list:
     return [s + timedelta(x) for x in range(0, days, step)]
 
 
+def dwindows(s: date, e: date, days: int) -> list:
+    """Split the dates from start date to end date into windows of days
+
+    Windows are ordered from the start date side like drange().
+
+    Args:
+        s (date): start date
+        e (date): end date (included)
+        days (int): max days per window
+
+    Returns:
+        [(date, date)]: (older date, newer date) of each window
+    """
+    step = 1 if e >= s else -1
+    windows = []
+    cur = s
+    while (e - cur).days * step >= 0:
+        nxt = cur + timedelta(step * (days - 1))
+        if (e - nxt).days * step < 0:
+            nxt = e
+        windows.append(tuple(sorted((cur, nxt))))
+        cur = nxt + timedelta(step)
+    return windows
+
+
+def mwindows(s: date, e: date) -> list:
+    """Split the dates from start date to end date into calendar months
+
+    Args:
+        s (date): start date
+        e (date): end date (included)
+
+    Returns:
+        [(date, date)]: (first day, last day) of each month, older first
+    """
+    s, e = sorted((s, e))
+    windows = []
+    cur = s.replace(day=1)
+    while cur <= e:
+        nxt = (cur + timedelta(32)).replace(day=1)
+        windows.append((cur, nxt - timedelta(1)))
+        cur = nxt
+    return windows
+
+
+def internShort(value):
+    u""" _INTERN_LEN文字までの文字列ならinternしたものを返す それ以外はそのまま """
+    if type(value) is str and len(value) <= _INTERN_LEN:
+        return sys.intern(value)
+    return value
+
+
+def parseItemDate(item):
+    u""" itemの日付 display_date, insert_datetime, start_date, publishFromDateTimeの順に探す 空も無いとみなす 無ければNone """
+    if item.get("display_date"):
+        return date.fromisoformat(item["display_date"])
+    elif item.get("insert_datetime"):  # "2022-04-01 15:42:09",
+        return date.fromisoformat(item["insert_datetime"].split(" ")[0])
+    elif item.get("start_date"):
+        return date.fromisoformat(item["start_date"])
+    elif item.get("publishFromDateTime"):  # "2022-04-01T10:40:44Z",
+        return date.fromisoformat(item["publishFromDateTime"].split("T")[0])
+    return None
+
+
+def parseDisplayDate(item):
+    u""" itemの表示日 display_date, 無ければstart_date 空も無いとみなす 無ければNone """
+    if item.get("display_date"):
+        return date.fromisoformat(item["display_date"])
+    elif item.get("start_date"):
+        return date.fromisoformat(item["start_date"])
+    return None
+
+
+def parseItemDateTime(item):
+    u""" itemの日時 insert_datetime, 無ければupdate_datetime 空も無いとみなす 無ければNone """
+    if item.get("insert_datetime"):
+        return datetime.fromisoformat(item["insert_datetime"])
+    elif item.get("update_datetime"):
+        return datetime.fromisoformat(item["update_datetime"])
+    return None
+
+
+def parseTime(txt):
+    u""" "HH:MM" または "HH:MM:SS" をtimeにする 空やおかしな値ならNone """
+    try:
+        return time.fromisoformat(txt) if txt else None
+    except ValueError:
+        return None
+
+
+def parseFloat(txt):
+    u""" 数値にする 空やおかしな値ならNone """
+    try:
+        return float(txt) if txt not in (None, "") else None
+    except ValueError:
+        return None
+
+
+def analyticsValue(value, typ):
+    u""" 分析用の表の値を列の型にそろえる 文字列の列は数値などもstrにする """
+    if value is None or typ != "string":
+        return value
+    return value if isinstance(value, str) else json.dumps(value, ensure_ascii=False)
+
+
+def csvValue(value):
+    if value is None:
+        return ""
+    if isinstance(value, (date, time)):
+        return value.isoformat()
+    return value
+
+
+def _periodMinutes(period):
+    (sh, sm), (eh, em) = period
+    return (sh * 60 + sm, eh * 60 + em)
+
+
+def _gridCover(periods, parmin, n):
+    # 期間(分 両端を含む)ごとに、入るスロットの最初に+1、最後の次に-1をつけて累積和をとる
+    diff = [0] * (n + 1)
+    for s, e in periods:
+        i = max(int(-(-s // parmin)), 0)
+        j = min(int(e // parmin), n - 1)
+        if i <= j:
+            diff[i] += 1
+            diff[j + 1] -= 1
+    diff.pop()
+    return itertools.accumulate(diff)
+
+
+def sleepGrid(periodItems, cPeriodItems=(), attendItem=None, markers=(), parmin=_SLEEP_PARMIN):
+    u""" 1日の睡眠などの期間を、parmin分ごとのスロットの記号のリストにする
+
+    スロットの時刻mが periodItems のどれかに入っていれば"-"、cPeriodItems のどれかに入っていれば"x"、
+    そうでなければ" "で、attendItem に入っていれば"t"を付けます。期間は両端を含みます。
+    markers は (名前, 時, 分) で、m - parmin < 時刻 <= m のスロットに名前の1文字目を付けます。
+    期間ごとにスロットの差分をつけて累積和をとるので、スロット数と期間数の和に比例する時間で済みます。
+
+    Args:
+        periodItems (list): 期間 ((時, 分), (時, 分)) のリスト
+        cPeriodItems (list, optional): periodItemsより優先する期間のリスト
+        attendItem (tuple, optional): 登園の期間
+        markers (list, optional): (名前, 時, 分) のリスト
+        parmin (int, optional): 1スロットの分数
+
+    Returns:
+        list: スロットごとの記号
+    """
+    n = int(60 * 24 / parmin)
+    cover = _gridCover(map(_periodMinutes, periodItems), parmin, n)
+    cCover = _gridCover(map(_periodMinutes, cPeriodItems), parmin, n)
+    aCover = _gridCover([_periodMinutes(attendItem)] if attendItem else [], parmin, n)
+    marks = {}
+    for text, mh, mm in markers:
+        i = int((mh * 60 + mm) // parmin)
+        if 0 <= i < n:
+            marks[i] = marks.get(i, "") + text[0]
+    return [
+        ("x" if c else "-" if x else " ") + ("t" if a else "") + marks.get(i, "")
+        for i, (x, c, a) in enumerate(zip(cover, cCover, aCover))]
+
+
+def sleepGridHeader(parmin=_SLEEP_PARMIN):
+    u""" sleepGridのスロットの見出し 毎時0分のスロットに時を入れる """
+    return ["%d" % (i * parmin // 60) if (i * parmin) % 60 == 0 else "" for i in range(int(60 * 24 / parmin))]
+
+
 def parseContnentDisporition(cd):
     log.debug(urllib.parse.unquote(cd))
     fns = re.findall(r'filename\*=([\w-]+)\'\'([\w\.%\(\)\+\-]+)$', cd)
@@ -1237,26 +3078,241 @@ def parseContnentDisporition(cd):
     return urllib.parse.unquote(fns[0][1])
 
 
+def backoffDelay(attempt, retryAfter=None):
+    u""" attempt回目(0から)の失敗の後に待つ秒数
+
+    上限を_BACKOFF_BASE * 2**attemptとして0からの一様乱数にします(full jitter)。
+    retryAfterがあれば少なくともその秒数待ちます。
+    """
+    delay = random.uniform(0, min(_BACKOFF_MAX, _BACKOFF_BASE * 2 ** attempt))
+    if retryAfter is not None:
+        delay = max(delay, min(retryAfter, _BACKOFF_MAX))
+    return delay
+
+
+def parseRetryAfter(value):
+    u""" Retry-Afterヘッダ(秒数かHTTP日付)を秒数にする 無いか読めなければNone """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if at.tzinfo is None:
+        at = at.replace(tzinfo=timezone.utc)
+    return max(0.0, (at - datetime.now(timezone.utc)).total_seconds())
+
+
 def dictmerge(d1, d2):
     return {**d1, **d2}
 
 
+@functools.lru_cache(maxsize=None)
+def _widePatterns():
+    u""" 幅2の文字の正規表現を作る 初めて使うときに1回だけ
+
+    BMPの文字についてunicodedata.east_asian_widthがFWAのどれかになる範囲の表を作り、
+    文字クラスにします。BMP外の文字は都度unicodedata.east_asian_widthで調べます。
+
+    Returns:
+        tuple: (幅2の文字の連続, 折り返しの単位(空白の連続 | 幅2の文字の連続 | その他の文字の連続))
+    """
+    ranges = []
+    for code in range(0x10000):
+        if 0xD800 <= code < 0xE000 or unicodedata.east_asian_width(chr(code)) not in 'FWA':
+            continue
+        if ranges and ranges[-1][1] == code - 1:
+            ranges[-1][1] = code
+        else:
+            ranges.append([code, code])
+    wide = "".join("\\u%04x-\\u%04x" % (s, e) for s, e in ranges)
+    return (
+        re.compile("[%s]+" % wide),
+        re.compile("( +)|([%s]+)|([^ %s]+)" % (wide, wide)))
+
+
+_ASTRAL = re.compile("[\U00010000-\U0010ffff]")
+_WRAP_SPACES = str.maketrans("\t\n\v\f\r", "     ")
+
+
 def width(txt: str):
     """ 全角半角を考慮してtextの幅を得る
-    
+
     unicodedata.east_asian_width で FWA のどれかなら 2 それ以外は1の幅として合計を得る
-    
+    ASCIIだけならlen、それ以外はBMPの幅の表から作った正規表現で幅2の文字を数えます。
+
     Args:
         txt (str): テキスト
 
     Returns:
         int: width
-    """    
-    return sum(2 if unicodedata.east_asian_width(x) in 'FWA' else 1 for x in txt)
+    """
+    if txt.isascii():
+        return len(txt)
+    n = len(txt) + sum(map(len, _widePatterns()[0].findall(txt)))
+    for x in _ASTRAL.findall(txt):
+        if unicodedata.east_asian_width(x) in 'FWA':
+            n += 1
+    return n
+
+
+def _splitWidth(txt: str, cols: int):
+    # 幅colsに収まる先頭部分と残りに分ける 少なくとも1文字は先頭に入れる
+    n = 0
+    for i, x in enumerate(txt):
+        n += width(x)
+        if n > cols:
+            return txt[:max(i, 1)], txt[max(i, 1):]
+    return txt, ""
+
+
+def wrap(txt: str, cols: int):
+    u""" 全角半角を考慮してtxtを幅colsの行に折り返す
+
+    textwrap.wrapと同じく、空白で区切られた単語の途中では折り返さず、
+    幅colsより長い単語は途中で折り返します。続けて書かれた全角文字はどこでも折り返しますが、
+    句読点や閉じ括弧が行頭に来るときは前の文字ごと次の行に送ります。
+    折り返した行の先頭と末尾の空白は取り除きます。
+
+    Args:
+        txt (str): テキスト
+        cols (int): 折り返す幅
+
+    Returns:
+        list: 折り返した行 空の行は含みません
+    """
+    lines = []
+    cur = []
+    curw = 0
+    for m in _widePatterns()[1].finditer(txt.expandtabs().translate(_WRAP_SPACES)):
+        chunk = m.group()
+        if m.lastindex == 2:
+            # 全角の連続はどこでも折り返す
+            while curw + 2 * len(chunk) > cols:
+                n = (cols - curw) // 2
+                while 0 < n < len(chunk) and chunk[n] in _WRAP_CLOSING:
+                    n -= 1
+                if n == 0 and not cur:
+                    n = max(cols // 2, 1)
+                cur.append(chunk[:n])
+                lines.append("".join(cur).rstrip(" "))
+                cur, curw = [], 0
+                chunk = chunk[n:]
+            if chunk:
+                cur.append(chunk)
+                curw += 2 * len(chunk)
+            continue
+        w = len(chunk) if chunk.isascii() else width(chunk)
+        if cur and curw + w > cols and (w <= cols or m.lastindex == 1):
+            lines.append("".join(cur).rstrip(" "))
+            cur, curw = [], 0
+        if m.lastindex == 1 and not cur and lines:
+            continue
+        while curw + w > cols:
+            # 1行に収まらない単語は残りの幅で切る
+            head, chunk = _splitWidth(chunk, cols - curw)
+            if cur and width(head) > cols - curw:
+                head, chunk = "", head + chunk
+            cur.append(head)
+            lines.append("".join(cur).rstrip(" "))
+            cur, curw = [], 0
+            w = width(chunk)
+        cur.append(chunk)
+        curw += w
+    lines.append("".join(cur).rstrip(" "))
+    return [x for x in lines if x]
+
+
+# 全文検索の語にする文字の並び 英数字とそれ以外を分ける
+_SEARCH_RUN = re.compile(r"[0-9A-Za-z]+|[^\W0-9A-Za-z_]+")
+# 検索結果に表示する本文の文字数
+_SEARCH_SNIPPET = 60
+
+# htmlToRstで使う正規表現
+_HTML_TAG = re.compile(r"<[^>]*>")
+_HTML_TABLE = re.compile(r"<table.*?>(.*?)</table>")
+_HTML_TR = re.compile(r"<tr.*?>(.*?)</tr>")
+_HTML_TD = re.compile(r"<td.*?>(.*?)</td>")
+# 改行にするタグ(group 1)、その他のタグ、&nbsp; を1回の走査で拾う
+# その他のタグの中に改行にするタグがあっても、その>ではタグを閉じない
+_HTML_TOKEN = re.compile(
+    r"<(?:(br>|/(?:h\d|p)>)"
+    r"|[^<>]*(?:(?:<br>|</(?:h\d|p)>|<(?!br>|/(?:h\d|p)>))[^<>]*)*>)"
+    r"|&nbsp;")
+# 3個以上の連続した改行(2個にする)、行頭の空白とTABLEMARK(削除する)
+_HTML_LINES = re.compile(r"(\n\n)\n+|^[ 　]*TABLEMARK|^[ 　]+", re.MULTILINE)
+_HTML_TABLEMARK = re.compile(r"^TABLEMARK", re.MULTILINE)
+
+
+def itemSearchText(kind, item):
+    u""" 検索する(タイトル, 本文)を得る 連絡帳はcontentのjsonのmemo、handoutは添付ファイル名も本文にする """
+    title = item.get("title") or ""
+    content = item.get("content") or ""
+    if kind == "handouts":
+        names = [urllib.parse.unquote(att.get("fileName") or "") for att in item.get("attachments") or []]
+        return title, "\n".join(names)
+    if kind == "comments" or item.get("timeline_kind") == "comments":
+        try:
+            content = json.loads(content).get("memo") or ""
+        except (ValueError, AttributeError):
+            pass
+    elif item.get("timeline_kind") == "bills":
+        return "", ""
+    return title, html.unescape(removeTag(content)).strip()
+
+
+def searchTokens(txt):
+    u""" 検索インデックスに入れる語のイテレータ
+
+    NFKCで正規化して、英数字の並びはそのまま、それ以外の文字の並びはbigramと最後の1文字にします。
+    """
+    for m in _SEARCH_RUN.finditer(unicodedata.normalize("NFKC", txt)):
+        run = m.group()
+        if run.isascii():
+            yield run
+            continue
+        for i in range(len(run) - 1):
+            yield run[i:i + 2]
+        yield run[-1]
+
+
+def searchQuery(query):
+    u""" 検索語をFTS5のMATCH式にする 語ごとにbigramのフレーズにして、すべてを含む(AND)ものに一致させる
+
+    1文字の語はその文字で始まる語(前方一致)にします。
+    """
+    phrases = []
+    for m in _SEARCH_RUN.finditer(unicodedata.normalize("NFKC", query)):
+        run = m.group()
+        if run.isascii():
+            phrases.append('"%s"' % run)
+        elif len(run) == 1:
+            phrases.append('"%s"*' % run)
+        else:
+            phrases.append('"%s"' % " ".join(run[i:i + 2] for i in range(len(run) - 1)))
+    return " ".join(phrases)
+
+
+def searchSnippet(text, query, cols=_SEARCH_SNIPPET):
+    u""" textのqueryの語が最初に現れるあたりを1行で返す """
+    text = unicodedata.normalize("NFKC", text)
+    lower = text.lower()
+    pos = -1
+    for m in _SEARCH_RUN.finditer(unicodedata.normalize("NFKC", query).lower()):
+        pos = lower.find(m.group())
+        if pos >= 0:
+            break
+    start = max(pos - cols // 3, 0)
+    snippet = " ".join(text[start:start + cols].split())
+    return ("…" if start else "") + snippet
 
 
 def removeTag(txt):
-    return re.sub(r"<.*?>", " ", txt, flags=re.MULTILINE | re.DOTALL)
+    return _HTML_TAG.sub(" ", txt)
 
 
 def htmlTableToRstListTable(txt):
@@ -1264,15 +3320,15 @@ def htmlTableToRstListTable(txt):
         # tableタグのマッチを rstのlist-tableへと変換する
         txt = m.group(1)
         rows = []
-        for tr in re.finditer(r"<tr.*?>(.*?)</tr>", txt):
+        for tr in _HTML_TR.finditer(txt):
             row = tr.group(1)
             cols = []
-            for td in re.finditer(r"<td.*?>(.*?)</td>", row):
+            for td in _HTML_TD.finditer(row):
                 col = td.group(1)
                 col = removeTag(col)
                 cols.append(col)
             rows.append(cols)
-        maxcol = max([len(x) for x in rows])
+        maxcol = max([len(x) for x in rows], default=0)
         indent = " " * 4
         lines = ["\n"]
         lines.append(".. list-table::\n")
@@ -1285,29 +3341,35 @@ def htmlTableToRstListTable(txt):
                 lines.append(line)
         lines = ["TABLEMARK" + x for x in lines]
         return "\n".join(lines) + "\n"
-    return re.sub(r"<table.*?>(.*?)</table>", procTable, txt)
+    return _HTML_TABLE.sub(procTable, txt)
+
+
+def _htmlToken(m):
+    return " " if m.group(1) is None else "\n"
+
+
+def _htmlLine(m):
+    return m.group(1) or ""
 
 
 def htmlToRst(txt):
-    content = htmlTableToRstListTable(txt)
-    # HTMLの一部タグを改行にする
-    content = re.sub(r"<br>", "\n", content, flags=re.MULTILINE)
-    content = re.sub(r"</(h\d|p)>", "\n", content, flags=re.MULTILINE)
-    # その他タグを削除する。
-    content = re.sub(r"<.*?>", " ", content, flags=re.MULTILINE | re.DOTALL)
-    content = re.sub(r"&nbsp;", " ", content, flags=re.MULTILINE)
-    # 3個以上の連続した空白文字を3個にする
-    # content = re.sub(r"[\t 　]{3,}", " ", content)
-    # 3個以上の連続した改行を2個にする
-    content = re.sub(r"\n{3,}", "\n\n", content, flags=re.MULTILINE)
-    content = re.sub(r"^[ 　]+", "", content, flags=re.MULTILINE)
-
-    def wrapJoin(m):
-        line = m.group(1)
-        return "\n".join(textwrap.wrap(line, width=30))
-    content = re.sub(r"^(.*?)$", wrapJoin, content)
-    content = re.sub(r"^TABLEMARK(.*?)$", r"\1", content, flags=re.MULTILINE)
-    return content
+    u""" HTMLをrstに変換する
+
+    tableはlist-tableにし、<br>と</p>, </hN>は改行、その他のタグと&nbsp;は空白にします。
+    タグの変換は1回の走査で、改行と行頭の空白の整理ももう1回の走査で行います。
+    全体が1行だけのときは_WRAP_WIDTHの幅で折り返します。
+    """
+    if "<table" in txt:
+        txt = htmlTableToRstListTable(txt)
+    content = _HTML_TOKEN.sub(_htmlToken, txt)
+    lines = _HTML_LINES.sub(_htmlLine, content)
+    # 最後の行がTABLEMARKを消して空になっただけなら1行とはみなさない
+    if "\n" in lines[:-1] or (lines.endswith("\n") and content[content.rfind("\n") + 1:].lstrip(" 　")):
+        return lines
+    # 1行だけなら折り返す TABLEMARKを消すのは折り返した後
+    line = content.split("\n", 1)[0].lstrip(" 　")
+    content = "\n".join(wrap(line, _WRAP_WIDTH)) + ("\n" if lines.endswith("\n") else "")
+    return _HTML_TABLEMARK.sub("", content)
 
 
 def callSphinxSetup(outputdir):
@@ -1345,8 +3407,79 @@ def sanitize_filename(filename):
     return filename.translate(table)
 
 
-def pdfextract(dumpmon):
+def processPool(processes):
+    u""" processes個のプロセスプール 1以下ならNone
+
+    ダウンロードやプールのスレッドが動いている間に作るので、forkでロックを持ったまま複製されないように
+    spawnで子プロセスを起動します。
+    """
+    if processes <= 1:
+        return None
+    return ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn"))
+
+
+def fileSha256(fn):
+    u""" fnの内容のsha256(16進)を返す """
+    sha = hashlib.sha256()
+    with open(fn, 'rb') as f:
+        for chunk in iter(lambda: f.read(_CHUNK_SIZE), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def extractPdf(job):
+    u""" PDFの画像をoutdirに書き出す
+
+    ページは1枚ずつ読み、画像も1つずつ書き出すので、保持するのは処理中の画像だけです。
+    同じxrefの画像(毎ページのロゴ等)は最初の1回だけ取り出し、
+    xrefが違っても内容が同じ画像は書き出しません。
+
+    Args:
+        job (tuple): (PDFのパス, 出力フォルダ)
+
+    Returns:
+        tuple: (ページ数, [(書き出したファイルのパス, sha256)])
+    """
     import fitz
+    src, outdir = job
+    os.makedirs(outdir, exist_ok=True)
+    files = []
+    xrefs = set()
+    shas = set()
+    with fitz.open(src) as pdf:
+        pages = pdf.page_count
+        for i in range(pages):
+            page = pdf.load_page(i)
+            for j, img in enumerate(page.get_images()):
+                xref = img[0]
+                if xref in xrefs:
+                    continue
+                xrefs.add(xref)
+                img_data = pdf.extract_image(xref)
+                if not img_data:
+                    continue
+                sha = hashlib.sha256(img_data["image"]).hexdigest()
+                if sha in shas:
+                    continue
+                shas.add(sha)
+                name = p.join(outdir, "%04d_%04d.%s" % (i, j, img_data["ext"]))
+                with open(name, "wb") as f:
+                    f.write(img_data["image"])
+                files.append((name, sha))
+                del img_data
+    return pages, files
+
+
+def pdfextract(dumpmon, processes=1):
+    u""" 資料室と各サービスのフォルダにあるPDFの画像を書き出す
+
+    PDFごとに内容のsha256をキーにしてmanifestに書き出したファイルを記録し、
+    揃っているPDFは開かずに飛ばします。
+    PDFはprocesses個のプロセスで並列に処理します。
+
+    Args:
+        processes (int, optional): 並列に処理するプロセス数 Defaults to 1.
+    """
     procPathes = [
         dumpmon.handoutDownloadFolder()
     ]
@@ -1363,22 +3496,91 @@ def pdfextract(dumpmon):
                 for fn in files:
                     if fn.endswith(".pdf"):
                         yield (dirpath, fn)
-    for dirpath, fn in listPdf():
-        outdir = p.join(dirpath, p.splitext(fn)[0])
-        log.info("extract: %s" % outdir)
-        os.makedirs(outdir, exist_ok=True)
-        try:
-            pdf = fitz.open(p.join(dirpath, fn))
-        except Exception:
-            raise
-        for i, page in enumerate(pdf):
-            for j, img in enumerate(page.get_images()):
-                img_id = img[0]
-                img_data = pdf.extract_image(img_id)
-                name = p.join(outdir, "%04d_%04d.%s" % (i, j, img_data["ext"]) )
-                with open(name, "wb") as f:
-                    f.write(img_data["image"])
+    def iterJobs():
+        for dirpath, fn in listPdf():
+            src = p.join(dirpath, fn)
+            outdir = p.join(dirpath, p.splitext(fn)[0])
+            key = "pdf:%s:%s" % (fileSha256(src), p.relpath(outdir, dumpmon.outputdir))
+            if dumpmon.manifest.complete(key):
+                log.debug("extracted: %s" % outdir)
+                continue
+            log.info("extract: %s" % outdir)
+            jobs.append(key)
+            yield (src, outdir)
+    jobs = collections.deque()
+    executor = processPool(processes)
+    if executor is not None:
+        results = dumpmon.iterMap(extractPdf, iterJobs(), pool=executor, width=processes * 2)
+    else:
+        results = map(extractPdf, iterJobs())
+    totalPages = 0
+    start = monotonic()
+    try:
+        for pages, files in results:
+            dumpmon.manifest.record(jobs.popleft(), files)
+            totalPages += pages
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        dumpmon.manifest.save()
+    elapsed = monotonic() - start
+    log.info("pdf extract: %d pages, %.1f pages/sec" % (totalPages, totalPages / elapsed if elapsed else 0))
+
+
+def searchMain(argv):
+    u""" dumpmon.py search の入口 保存したitemを全文検索して新しい順に表示する """
+    parser = argparse.ArgumentParser(
+        prog="dumpmon.py search",
+        description="Searches dumped codmon items.",
+    )
+    parser.add_argument("query", nargs="*", help="words to search (all words must match)")
+    parser.add_argument(
+        "-r", "--range", type=date.fromisoformat,
+        nargs=2, metavar=("YYYY-MM-DD", "YYYY-MM-DD"),
+        help="limit to a date range")
+    parser.add_argument("-s", "--service", action="append", help="limit to a service name or id")
+    parser.add_argument(
+        "-n", "--limit", type=int, default=_SEARCH_LIMIT,
+        help="max results (default: %(default)s)")
+    parser.add_argument(
+        "--reindex", action="store_true",
+        help="add all dumped items to the index (needed once for items fetched before indexing)")
+    parser.add_argument(
+        "--store", choices=_STORES, default=_DEFAULT_STORE,
+        help="storage for fetched items (default: %(default)s)")
+    parser.add_argument("-v", "--verbosity", help="increase output verbosity", action="store_true")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig()
+    log.setLevel(level=logging.DEBUG if args.verbosity else logging.INFO)
+
+    dumpmon = Dumpmon(store=args.store)
+    index = dumpmon.searchIndex()
+    if args.reindex:
+        start = monotonic()
+        n = dumpmon.reindex()
+        log.info("reindex: %d items, %.2f sec" % (n, monotonic() - start))
+    elif index.count() == 0:
+        log.warning("search index is empty. run with --reindex to index dumped items.")
+    if not args.query:
+        return
 
+    srvs = dumpmon.getServices()
+    services = None
+    if args.service:
+        services = [sid for sid in srvs.keys() if sid in args.service or srvs[sid]["name"] in args.service]
+        if not services:
+            parser.error("unknown service: %s" % ", ".join(args.service))
+    s_date, e_date = args.range if args.range else (None, None)
+    query = " ".join(args.query)
+    start = monotonic()
+    rows = index.search(query, services, s_date, e_date, args.limit)
+    elapsed = monotonic() - start
+    for service, kind, item_id, display_date, title, text in rows:
+        name = srvs[service]["name"] if service in srvs else "資料室"
+        print("%s %s %s %s" % (display_date, name, kind, title))
+        print("    %s" % searchSnippet(text or title, query))
+    log.info("%d items, %.1f ms" % (len(rows), elapsed * 1000))
 
 
 def main():
@@ -1388,6 +3590,9 @@ def main():
 
     """
 
+    if sys.argv[1:2] == ["search"]:
+        return searchMain(sys.argv[2:])
+
     # --- init argument parse
 
     parser = argparse.ArgumentParser(
@@ -1400,8 +3605,18 @@ def main():
     phase.add_argument("-dl", "--download", help="download attachment file", action="store_true")
     phase.add_argument("-m", "--makenote", help="make communication notebook", action="store_true")
     phase.add_argument("-s", "--makesleep", help="make sleep data", action="store_true")
+    phase.add_argument(
+        "--analytics", choices=_ANALYTICS_FORMATS, nargs="?", const="csv",
+        help="export temperatures, sleeps, attendances and moods/meals as typed tables (default: csv)")
     phase.add_argument("-b", "--builddoc", help="build sphinx document", action="store_true")
     phase.add_argument("-ext", "--extract", help="extract pdf images", action="store_true")
+    phase.add_argument("--export", help="export sqlite store to json files", action="store_true")
+    phase.add_argument(
+        "--import", dest="import_", action="store_true",
+        help="import dumped json files into the sqlite store (once, when switching to --store sqlite)")
+    phase.add_argument(
+        "--pipeline", action="store_true",
+        help="overlap fetch, download, makenote and document build (when no phase is limited)")
 
     daterange = parser.add_argument_group(title="daterange", description="Fetch Date Range")
     group = daterange.add_mutually_exclusive_group()
@@ -1428,6 +3643,45 @@ def main():
     phase.add_argument(
         "-od", "--outputdir", type=str,
         help="output directory")
+    phase.add_argument(
+        "--store", choices=_STORES, default=_DEFAULT_STORE,
+        help="storage for fetched items (default: %(default)s)")
+    phase.add_argument(
+        "--cache-mb", type=int, default=_DEFAULT_CACHE_BYTES // (1024 * 1024),
+        help="approximate memory cap of the dumped item cache in MB,"
+             " estimated from the item file sizes (default: %(default)s)")
+    phase.add_argument(
+        "-j", "--jobs", type=int, default=1,
+        help="number of processes to render notebook months and extract pdf images (default: %(default)s)")
+
+    network = parser.add_argument_group(title="network", description="Server access control")
+    network.add_argument(
+        "--rate", type=float, default=_DEFAULT_RATE,
+        help="max requests per second (default: %(default)s)")
+    network.add_argument(
+        "--burst", type=int, default=_DEFAULT_BURST,
+        help="max burst requests (default: %(default)s)")
+    network.add_argument(
+        "--workers", type=int, default=_DEFAULT_WORKERS,
+        help="concurrent requests (default: %(default)s)")
+    network.add_argument(
+        "--prefetch", type=int, default=_PREFETCH_PAGES,
+        help="pages of the timeline and handouts to request ahead; helps only when"
+             " rate x round-trip time exceeds 1 (default: %(default)s)")
+    network.add_argument(
+        "--downloads", type=int, default=_DEFAULT_DOWNLOADS,
+        help="concurrent attachment downloads (default: %(default)s)")
+    network.add_argument(
+        "--http", choices=_HTTP_CLIENTS, default=_DEFAULT_HTTP_CLIENT,
+        help="client for API requests. httpx uses a pooled async HTTP/2 client"
+             " with per-host limits (needs httpx) (default: %(default)s)")
+    network.add_argument(
+        "--no-http-cache", dest="httpcache", action="store_false",
+        help="do not send conditional requests (ETag / If-Modified-Since)")
+    network.add_argument(
+        "--window", choices=sorted(_WINDOW_DAYS.keys()), default=_DEFAULT_WINDOW,
+        help="date range per request for comments and contact responses;"
+             " full windows are split and fetched again, use day as a fallback (default: %(default)s)")
 
     parser.add_argument("-v", "--verbosity", help="increase output verbosity", action="store_true")
     parser.add_argument("-q", "--quiet", help="quietly", action="store_true")
@@ -1460,7 +3714,7 @@ def main():
         e_date = None
     else:
         with Config() as conf:
-            if "lastFetchedDate" in conf:
+            if conf.get("lastFetchedDate"):
                 s_date = date.today()
                 e_date = date.fromisoformat(conf["lastFetchedDate"])
                 log.info("Fetches data up to the following dates: %s" % e_date.isoformat())
@@ -1470,13 +3724,37 @@ def main():
 
     # --- phase select
 
-    partialExecutionEnabled = args.fetch or args.download or args.makenote or args.builddoc or args.extract or args.makesleep
+    # 日付範囲の指定が無ければ、エンドポイントごとに前回取得した所まで取得する
+    incremental = not (args.all or args.day or args.range)
+
+    partialExecutionEnabled = (
+        args.fetch or args.download or args.makenote or args.builddoc or args.extract or args.makesleep
+        or args.export or args.import_ or args.analytics)
     allExecute = not partialExecutionEnabled
+    # --pipelineなら取得からビルドまでをrunPipeline()で重ねて行う
+    sequential = allExecute and not args.pipeline
 
     # -- login
 
     log.debug("debug")
-    dumpmon = Dumpmon(start_date=s_date, end_date=e_date, outputdir=args.outputdir)
+    dumpmon = Dumpmon(
+        start_date=s_date, end_date=e_date, outputdir=args.outputdir,
+        rate=args.rate, burst=args.burst, workers=args.workers, window=args.window,
+        downloads=args.downloads, httpcache=args.httpcache, http=args.http, prefetch=args.prefetch,
+        incremental=incremental, store=args.store, cache_bytes=args.cache_mb * 1024 * 1024)
+
+    # --- import json files to sqlite store
+
+    if dumpmon.store is not None:
+        if args.import_:
+            log.info("import...")
+            log.info("imported: %d items" % dumpmon.importStore())
+        elif dumpmon.store.count() == 0 and dumpmon.hasJsonDumps():
+            # jsonの履歴が見えないまま取得すると、カーソルより前のitemは二度と取得されない
+            parser.error("%s is empty but json dumps exist in %s. run once with --store sqlite --import"
+                         % (_STORE_FILE, _DUMPDIR))
+    elif args.import_:
+        parser.error("--import needs --store sqlite")
     if not dumpmon.testLogin():
         dumpmon.login()
         while (not dumpmon.testLogin()):
@@ -1485,9 +3763,13 @@ def main():
     dumpmon.fetchServices()
     dumpmon.fetchChildren()
 
+    if allExecute and args.pipeline:
+        log.info("pipeline...")
+        dumpmon.runPipeline(processes=args.jobs)
+
     # --- fetch phase
 
-    if allExecute or args.fetch:
+    if sequential or args.fetch:
         log.info("fetchTimeline...")
         dumpmon.fetchTimeline()
         log.info("fetchComments...")
@@ -1496,10 +3778,12 @@ def main():
         dumpmon.fetchContactResponses()
         log.info("fetchHandouts...")
         dumpmon.fetchHandouts()
+        log.info("fetchAttendances...")
+        dumpmon.fetchAttendances()
 
     # --- download attach file phase
 
-    if allExecute or args.download:
+    if sequential or args.download:
         log.info("download...")
         dumpmon.downloadTimeline()
         dumpmon.downloadTimelinePhoto()
@@ -1507,15 +3791,17 @@ def main():
 
     if allExecute:
         with Config() as conf:
-            conf["lastFetchedDate"] = s_date.isoformat()
+            # --allや初回(s_dateがNone)は今日まで取得したことになる
+            fetched = max(s_date, e_date) if s_date and e_date else date.today()
+            conf["lastFetchedDate"] = fetched.isoformat()
         log.info("save last fetch date: %s" % conf["lastFetchedDate"])
 
     # --- meke communication notebook phase
 
-    if allExecute or args.makenote:
+    if sequential or args.makenote:
         log.info("makenote...")
-        dumpmon.makenote()
-    if allExecute or args.builddoc:
+        dumpmon.makenote(processes=args.jobs)
+    if sequential or args.builddoc:
         log.info("build document...")
         callSphinxSetup(dumpmon.outputdir)
         callSphinxBuild(dumpmon.outputdir)
@@ -1524,11 +3810,23 @@ def main():
     if args.makesleep:
         log.info("sleep...")
         dumpmon.makeSleep()
+    if args.analytics:
+        log.info("analytics...")
+        dumpmon.exportAnalytics(args.analytics)
+
+    log.debug("item cache: hits=%d misses=%d" % (dumpmon.itemcache.hits, dumpmon.itemcache.misses))
+    if dumpmon.httpcache is not None:
+        log.info("http cache: hits=%d misses=%d" % (dumpmon.httpcache.hits, dumpmon.httpcache.misses))
+
+    # --- export sqlite store to json files
+    if args.export:
+        log.info("export...")
+        dumpmon.exportStore()
 
     # --- PDF extract
     if args.extract:
         log.info("pdf extract...")
-        pdfextract(dumpmon)
+        pdfextract(dumpmon, processes=args.jobs)
 
 
 if __name__ == "__main__":
@@ -3,26 +3,18 @@ import os.path as p
 import re
 import json
 
+from dumpmon import sleepGrid, sleepGridHeader
+
 # piyologのエクスポートファイルがあるフォルダ
 datapath = "~/data/piyolog"
+# エクスポートファイルごとの解析結果のキャッシュ 更新日時が変わったファイルだけ解析しなおす
+cachefile = "~/data/piyolog/piyo_cache.json"
 
 sleepings = "~/data/sleepings.json"
-sleepData = json.load(open(sleepings))
 parmin = 5
 
 # dumpmonのattendances.json
 attendfile = "~/dumpmon/dump/attendances.json"
-attendData = {}
-for item in json.load(open(attendfile)):
-    ymd = item["start_date"]
-    s = item.get("start_time")
-    e = item.get("end_time")
-    if not s or not e:
-        continue
-    attendData[ymd] = [
-        [int(x) for x in s.split(":")[:2]],
-        [int(x) for x in e.split(":")[:2]],
-    ]
 
 datesep_rx = re.compile(r"^\-+$")
 # 2021/10/10(日)
@@ -39,14 +31,48 @@ birth_rx = re.compile(r"\((\d+.*?日)\)")
 # うんち合計
 infos_end = re.compile(r'うんち合計 \d+回')
 
+def loadSleepData(fn=sleepings):
+    """ 日付("YYYY-MM-DD")ごとの園での午睡の期間 [((時, 分), (時, 分)), ...] の辞書 """
+    sleepData = {}
+    with open(p.expanduser(fn), encoding="utf-8") as f:
+        for ymd, rngs in json.load(f).items():
+            sleepData[ymd] = [((int(s[0]), int(s[1])), (int(e[0]), int(e[1]))) for s, e in rngs]
+    return sleepData
+
+
+def loadAttendData(fn=attendfile):
+    """ 日付("YYYY-MM-DD")ごとの登園の期間 [[時, 分], [時, 分]] の辞書 """
+    attendData = {}
+    with open(p.expanduser(fn), encoding="utf-8") as f:
+        for item in json.load(f):
+            ymd = item["start_date"]
+            s = item.get("start_time")
+            e = item.get("end_time")
+            if not s or not e:
+                continue
+            attendData[ymd] = [
+                [int(x) for x in s.split(":")[:2]],
+                [int(x) for x in e.split(":")[:2]],
+            ]
+    return attendData
+
+
 def procfile(fn):
-    lines = open(p.join(datapath, fn)).readlines()
+    return dict(iterDays(fn))
+
+
+def iterDays(fn):
+    """ エクスポートファイルを1行ずつ読んで、1日分ずつ (date_tuple, (birth_str, periodItems, text, markers)) を返す """
+    with open(p.join(p.expanduser(datapath), fn), encoding="utf-8") as lines:
+        yield from _iterDays(lines)
+
+
+def _iterDays(lines):
     phase = None
     # date_str = None
     date_tuple = None
     periodItems = []
     startItem = None
-    fileData = {}
     birth_str = None
     text = []
     markers = []
@@ -56,7 +82,7 @@ def procfile(fn):
                 x = (startItem, (23, 59))
                 periodItems[-1] = x
             if periodItems:
-                fileData[date_tuple] = (birth_str, periodItems, text, markers)
+                yield date_tuple, (birth_str, periodItems, text, markers)
             phase = "SEP"
             periodItems = []
             text = []
@@ -110,65 +136,60 @@ def procfile(fn):
             continue
         if phase == "TEXT":
             text.append(line)
-    return fileData
 
-def getCodmonPeriod(day):
+
+def loadAllData(path=datapath, cache=cachefile):
+    """ すべてのエクスポートファイルの日ごとのデータ
+
+    ファイルごとに更新日時と解析結果をcacheに保存しておき、更新日時が変わったファイルだけ解析します。
+    """
+    path = p.expanduser(path)
+    cache = p.expanduser(cache)
+    cached = {}
+    if p.isfile(cache):
+        with open(cache, encoding="utf-8") as f:
+            cached = json.load(f)
+    files = {}
+    changed = False
+    for fn in sorted(x for x in os.listdir(path) if x.endswith(".txt")):
+        mtime = os.stat(p.join(path, fn)).st_mtime_ns
+        entry = cached.get(fn)
+        if entry is None or entry["mtime"] != mtime:
+            entry = {"mtime": mtime, "days": [[list(day), rec] for day, rec in iterDays(fn)]}
+            changed = True
+        files[fn] = entry
+    if changed or files.keys() != cached.keys():
+        with open(cache, "w", encoding="utf-8") as f:
+            json.dump(files, f, ensure_ascii=False)
+
+    allData = {}
+    for entry in files.values():
+        for day, (birth_str, periodItems, text, markers) in entry["days"]:
+            allData[tuple(day)] = (
+                birth_str,
+                [tuple(tuple(x) for x in period) for period in periodItems],
+                text,
+                [tuple(x) for x in markers])
+    return allData
+
+
+def getCodmonPeriod(sleepData, day):
     ymd = "%04d-%02d-%02d" % day[0:3]
-    if ymd in sleepData:
-        for rng in sleepData[ymd]:
-            s = (int(rng[0][0]), int(rng[0][1]))
-            e = (int(rng[1][0]), int(rng[1][1]))
-            yield (s, e)
+    return sleepData.get(ymd, [])
+
 
-def getAttendPeriod(day):
+def getAttendPeriod(attendData, day):
     ymd = "%04d-%02d-%02d" % day[0:3]
-    if ymd in attendData:
-        return attendData.get(ymd)
+    return attendData.get(ymd)
 
-def main():
-    allData = {}
-    for f in [x for x in os.listdir(datapath) if x.endswith(".txt")]:
-        fileData = procfile(f)
-        allData.update(fileData)
-
-    def flagPerMin(periodItems, cPeriodItems, attendItem, markers):
-        """ parminごとに時間を進めてflagリストを返す """
-        for i in range(int(60*24 / parmin)):
-            m = i * parmin
-            isIn = " "
-            for period in periodItems:
-                (sh, sm), (eh, em) = period
-                s = sh * 60 + sm
-                e = eh * 60 + em
-                if s <= m and m <= e:
-                    isIn = "-"
-                    break
-            for period in cPeriodItems:
-                (sh, sm), (eh, em) = period
-                s = sh * 60 + sm
-                e = eh * 60 + em
-                if s <= m and m <= e:
-                    isIn = "x"
-                    break
-            if attendItem:
-                (sh, sm), (eh, em) = attendItem
-                s = sh * 60 + sm
-                e = eh * 60 + em
-                if s <= m and m <= e:
-                    isIn += "t"
-            for marker in markers:
-                text, mh, mm = marker
-                m_min = mh * 60 + mm
-                if m_min - parmin < m and m <= m_min:
-                    isIn += text[0]
-            yield isIn
 
+def main():
+    allData = loadAllData()
+    sleepData = loadSleepData()
+    attendData = loadAttendData()
 
     with open("sllep.csv", "w") as f:
-        head = ["", "", ""]
-        for i in range(int(60*24/parmin)):
-            h = int(i * parmin / 60)
-            head.append("%d" % h if ((i * 5) % int(60/parmin)) == 0 else "")
+        head = ["", "", ""] + sleepGridHeader(parmin)
         f.write(",".join(head) + "\n")
 
         nightSleepStarts = []
@@ -182,13 +203,13 @@ def main():
 
         for i, day in enumerate(sorted(allData.keys())):
             birth_str, periodItems, text, markers = allData[day]
-            pre7 = nightSleepStarts[:i][-7:]
+            pre7 = nightSleepStarts[max(i - 7, 0):i]
             if pre7:
                 sleep_ave = sum(pre7) / len(pre7)
                 markers.append(("ave", int(sleep_ave / 60), sleep_ave%60))
-            cPeriodItems = list(getCodmonPeriod(day))
-            attemdItem = getAttendPeriod(day)
-            flags = list(flagPerMin(periodItems, cPeriodItems, attemdItem, markers))
+            cPeriodItems = getCodmonPeriod(sleepData, day)
+            attemdItem = getAttendPeriod(attendData, day)
+            flags = sleepGrid(periodItems, cPeriodItems, attemdItem, markers, parmin)
             if birth_str.endswith("月0日"):
                 dayCol = "%04d/%02d/%02d(%s)" % day
                 birthCol = birth_str
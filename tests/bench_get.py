@@ -0,0 +1,94 @@
+u""" ローカルのスタブサーバーに対するGETのベンチマーク
+
+以前の直列の取得(1リクエストごとにsleep(1.0))と、TokenBucket+ワーカーのiterGetJson()を比べて、
+リクエスト/秒と全体の時間を表示する。pytestでは集めない。
+
+    python tests/bench_get.py [-n 20] [--latency 0.2]
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 以前のDumpmon.get()が1リクエストごとに待っていた時間
+SERIAL_SLEEP = 1.0
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    u""" latency秒待ってから {"success": true, "data": path} を返す """
+    protocol_version = "HTTP/1.1"
+    latency = 0.2
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        body = json.dumps({"success": True, "data": self.path}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def startServer(latency):
+    StubHandler.latency = latency
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def serialGet(dumpmon, urls):
+    u""" 以前の直列の取得 1つずつGETしてSERIAL_SLEEP秒待つ """
+    session = dumpmon.requests.Session()
+    for url in urls:
+        res = session.get(url)
+        res.json()
+        time.sleep(SERIAL_SLEEP)
+
+
+def report(name, n, elapsed):
+    print("%-32s %3d requests %6.2f s %6.2f req/s" % (name, n, elapsed, n / elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-n", type=int, default=20, help="requests per run (default: %(default)s)")
+    parser.add_argument("--latency", type=float, default=0.2, help="stub response time in seconds (default: %(default)s)")
+    args = parser.parse_args()
+
+    # 保存先のパスはimport時にHOMEから決まるので、一時ディレクトリにしてから読み込む
+    with tempfile.TemporaryDirectory(prefix="dumpmon-bench-") as home:
+        os.environ["HOME"] = home
+        sys.path.insert(0, ROOT)
+        import dumpmon
+        bench(dumpmon, args.n, args.latency)
+
+
+def bench(dumpmon, n, latency):
+    server = startServer(latency)
+    urls = ["http://127.0.0.1:%d/item/%d" % (server.server_address[1], i) for i in range(n)]
+
+    start = time.monotonic()
+    serialGet(dumpmon, urls)
+    report("serial (sleep %.1f s)" % SERIAL_SLEEP, n, time.monotonic() - start)
+
+    for rate, burst, workers in ((dumpmon._DEFAULT_RATE, dumpmon._DEFAULT_BURST, dumpmon._DEFAULT_WORKERS),
+                                 (10.0, 4, 4)):
+        d = dumpmon.Dumpmon(rate=rate, burst=burst, workers=workers, httpcache=False)
+        start = time.monotonic()
+        data = [resj["data"] for resj in d.iterGetJson(urls)]
+        report("rate %g burst %d workers %d" % (rate, burst, workers), n, time.monotonic() - start)
+        assert data == ["/item/%d" % i for i in range(n)]
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+import json
+import os
+import random
+import subprocess
+import sys
+from datetime import date, datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# HOMEを差し替えた子プロセスでdumpmonを読み込み、makenoteを実行する
+# (保存先のパスはimport時にHOMEから決まり、プロセスプールの子プロセスもHOMEから読み直すため)
+MAKENOTE = """
+import sys
+import dumpmon
+outdir, processes = sys.argv[1], int(sys.argv[2])
+d = dumpmon.Dumpmon()
+d.outputdir = outdir
+d.manifest = dumpmon.Manifest(outdir)
+d.makenote(processes=processes)
+"""
+
+WORDS = ["今日は", "元気に", "遊びました。", "お昼寝", "よく食べました", "hello world", "発熱", "　全角空白", "&nbsp;"]
+
+
+def makeCorpus(home, days=150, seed=1):
+    u""" 2サービス、days日分のtimeline, comments, contact_responsesのダンプを作る """
+    rnd = random.Random(seed)
+
+    def txt(n):
+        return "".join(rnd.choice(WORDS) for _ in range(n))
+
+    dump = os.path.join(home, "Desktop", "dumpmon", "dump")
+    os.makedirs(dump)
+    with open(os.path.join(dump, "services.json"), "w", encoding="utf-8") as f:
+        json.dump({"7": {"name": "svcA"}, "8": {"name": "svcB"}}, f)
+    with open(os.path.join(dump, "attendances.json"), "w", encoding="utf-8") as f:
+        json.dump([{"start_date": "2023-01-05", "start_time": "08:30:00", "end_time": "17:00:00"}], f)
+    iid = 1000
+    for sname in ("svcA", "svcB"):
+        for day in range(days):
+            dd = date(2022, 11, 20) + timedelta(day)
+            for _ in range(rnd.randint(0, 3)):
+                iid += 1
+                stamp = (datetime.combine(dd, datetime.min.time())
+                         + timedelta(minutes=rnd.randint(0, 1439))).strftime("%Y-%m-%d %H:%M:%S")
+                item = {"id": iid, "display_date": dd.isoformat(), "insert_datetime": stamp}
+                r = rnd.random()
+                if r < 0.4:
+                    kind = "timeline"
+                    memo = {"memo": "<p>%s</p><br>%s" % (txt(8), txt(20)), "mood_morning": "good"}
+                    item.update(timeline_kind="comments", kind="4", title="連絡帳", update_datetime=stamp,
+                                content=json.dumps(memo, ensure_ascii=False))
+                elif r < 0.6:
+                    kind = "timeline"
+                    item.update(timeline_kind="responses", kind=rnd.choice(["3", "6", "7", "8"]),
+                                title=txt(1), content="<h2>%s</h2>%s<br>%s" % (txt(2), txt(3), txt(12)))
+                elif r < 0.85:
+                    kind = "comments"
+                    memo = {"memo": txt(10) + "\n" + txt(5), "mood_morning": "ok"}
+                    item.update(kind="2", content=json.dumps(memo, ensure_ascii=False))
+                else:
+                    kind = "contact_responses"
+                    item.update(kind="6", title="遅刻・欠席連絡", content="遅刻\n\n" + txt(3))
+                fdr = os.path.join(dump, sname, kind)
+                os.makedirs(fdr, exist_ok=True)
+                with open(os.path.join(fdr, "%s_%s.json" % (dd.isoformat(), iid)), "w", encoding="utf-8") as f:
+                    json.dump(item, f, ensure_ascii=False, indent=4)
+
+
+def runMakenote(home, outdir, processes):
+    env = dict(os.environ, HOME=str(home), PYTHONPATH=ROOT)
+    subprocess.run([sys.executable, "-c", MAKENOTE, str(outdir), str(processes)], env=env, check=True)
+
+
+def readRst(outdir):
+    files = {}
+    for dirpath, dirnames, filenames in os.walk(outdir):
+        for fn in filenames:
+            if fn.endswith(".rst"):
+                path = os.path.join(dirpath, fn)
+                with open(path, "rb") as f:
+                    files[os.path.relpath(path, outdir)] = f.read()
+    return files
+
+
+def test_makenote_parallel_matches_serial(tmp_path):
+    makeCorpus(tmp_path)
+    runMakenote(tmp_path, tmp_path / "serial", 1)
+    runMakenote(tmp_path, tmp_path / "parallel", 2)
+    serial = readRst(tmp_path / "serial")
+    parallel = readRst(tmp_path / "parallel")
+    assert len(serial) > 5
+    assert parallel == serial
@@ -0,0 +1,40 @@
+import os
+import subprocess
+import sys
+
+from test_makenote import ROOT, makeCorpus
+
+# 既定の設定のDumpmonでmakenoteを実行し、tracemallocで測ったピークのメモリ(バイト)を出力する
+MAKENOTE_PEAK = """
+import sys
+import tracemalloc
+import dumpmon
+outdir = sys.argv[1]
+d = dumpmon.Dumpmon()
+d.outputdir = outdir
+d.manifest = dumpmon.Manifest(outdir)
+tracemalloc.start()
+d.makenote()
+print(tracemalloc.get_traced_memory()[1])
+"""
+
+
+def makenotePeak(home):
+    env = dict(os.environ, HOME=str(home), PYTHONPATH=ROOT)
+    res = subprocess.run(
+        [sys.executable, "-c", MAKENOTE_PEAK, str(home / "output")],
+        env=env, cwd=str(home), check=True, capture_output=True, text=True)
+    return int(res.stdout.split()[-1])
+
+
+def test_makenote_peak_memory_is_bounded(tmp_path):
+    u""" 月ごとに書き出すので、ピークのメモリはダンプの期間が4倍でもほとんど増えない """
+    oneYear = tmp_path / "one"
+    fourYears = tmp_path / "four"
+    makeCorpus(oneYear, days=365)
+    makeCorpus(fourYears, days=1460)
+    peak1 = makenotePeak(oneYear)
+    peak4 = makenotePeak(fourYears)
+    # 全件を持つと4年分で約10MBになる
+    assert peak4 < 2 * 1024 * 1024
+    assert peak4 < 2 * peak1